@@ -1,33 +1,11 @@
- -- Create tables
-CREATE TABLE product(
-	id INTEGER PRIMARY KEY NOT NULL,
-	name TEXT NOT NULL,
-	ingred TEXT,
-	calories REAL,
-	trans_fat REAL,
-	satu_fat REAL,
-	tot_fat REAL,
-	sodium REAL,
-	cholesterol REAL,
-	tot_carhy REAL,
-	diet_fiber REAL,
-	protein REAL,
-	sugars REAL,
-	labels TEXT,
-	serv_size TEXT,
-	tot_ser REAL,
-	store CHAR(10) NOT NULL
-);
-
-CREATE TABLE store(
-	id INTEGER PRIMARY KEY NOT NULL,
-	name CHAR(10) NOT NULL,
-	address TEXT NOT NULL,
-	city CHAR(20),
-	state CHAR(20),
-	zipcode CHAR(8),
-	FOREIGN KEY(name) REFERENCES product(store)
-);
+-- Superseded by FrontEnd/build_database.py, which builds the whole
+-- database in one step without pandas or the sqlite3 shell.  This script
+-- loads the product.csv and store.csv written by DataCleaning.py; the
+-- tables and indexes are defined in schema.sql and indexes.sql, which
+-- build_database.py reads as well.
+
+-- Create tables
+.read schema.sql
 
 
 -- Import csv files into tables
@@ -53,3 +31,11 @@ UPDATE product SET labels=NULL WHERE labels="";
 UPDATE product SET serv_size=NULL WHERE serv_size="";
 UPDATE product SET tot_ser=NULL WHERE tot_ser="";
 
+-- Create indexes once the data is loaded
+.read indexes.sql
+ANALYZE;
+
+
+-- Then build the search indexes (full-text, ingredient words, labels,
+-- store locations) with
+--   python FrontEnd/search_index.py foodsearch.sqlite3
@@ -0,0 +1,13 @@
+-- The indexes of foodsearch.sqlite3, created once the data is loaded, read
+-- by database.sql and by FrontEnd/build_database.py.  Each nutrient index
+-- carries the store so a range scan on the nutrient also yields the join
+-- key, and the store index covers every store column shown in the results.
+
+CREATE INDEX product_calories ON product(calories, store);
+CREATE INDEX product_trans_fat ON product(trans_fat, store);
+CREATE INDEX product_tot_fat ON product(tot_fat, store);
+CREATE INDEX product_sodium ON product(sodium, store);
+CREATE INDEX product_tot_carhy ON product(tot_carhy, store);
+CREATE INDEX product_protein ON product(protein, store);
+CREATE INDEX product_sugars ON product(sugars, store);
+CREATE INDEX store_name ON store(name, address, zipcode);
@@ -0,0 +1,32 @@
+-- The tables of foodsearch.sqlite3, read by database.sql and by
+-- FrontEnd/build_database.py
+
+CREATE TABLE product(
+	id INTEGER PRIMARY KEY NOT NULL,
+	name TEXT NOT NULL,
+	ingred TEXT,
+	calories REAL,
+	trans_fat REAL,
+	satu_fat REAL,
+	tot_fat REAL,
+	sodium REAL,
+	cholesterol REAL,
+	tot_carhy REAL,
+	diet_fiber REAL,
+	protein REAL,
+	sugars REAL,
+	labels TEXT,
+	serv_size TEXT,
+	tot_ser REAL,
+	store CHAR(10) NOT NULL
+);
+
+CREATE TABLE store(
+	id INTEGER PRIMARY KEY NOT NULL,
+	name CHAR(10) NOT NULL,
+	address TEXT NOT NULL,
+	city CHAR(20),
+	state CHAR(20),
+	zipcode CHAR(8),
+	FOREIGN KEY(name) REFERENCES product(store)
+);
@@ -0,0 +1,119 @@
+'''
+Prefix autocomplete over the words of product names.
+
+The distinct lowercased words are kept in one sorted list, with the number
+of products using each word in a parallel array.  The words starting with
+a prefix are a contiguous range of the list found by bisection; the top
+suggestions of every prefix of up to TOP_PREFIX_LENGTH letters, whose
+ranges are the longest, are computed when the list is built.
+'''
+
+import heapq
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+
+import search_items
+from search_index import WORD_RE
+
+
+# Number of suggestions returned by default, and at most
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+# Prefixes short enough to have their suggestions computed in advance
+TOP_PREFIX_LENGTH = 2
+
+
+class Suggester:
+    '''
+    The sorted words of the product names and their product counts.
+    '''
+
+    def __init__(self, conn):
+        counts = {}
+        for (name,) in conn.execute("SELECT name FROM product"):
+            for word in set(WORD_RE.findall((name or '').lower())):
+                counts[word] = counts.get(word, 0) + 1
+        self.words = sorted(counts)
+        self.counts = array('I', (counts[word] for word in self.words))
+        self.top = {}
+        for prefix in {word[:n] for word in self.words
+                       for n in range(1, TOP_PREFIX_LENGTH + 1)}:
+            self.top[prefix] = self._complete(prefix, MAX_LIMIT)
+
+    def _complete(self, prefix, limit):
+        '''
+        Returns the limit most used words starting with prefix, most used
+        first and in alphabetical order among equals.
+        '''
+        start = bisect_left(self.words, prefix)
+        end = bisect_left(self.words, prefix + '\uffff', start)
+        return heapq.nsmallest(
+            limit, range(start, end), key=lambda i: -self.counts[i])
+
+    def suggest(self, text, limit=DEFAULT_LIMIT):
+        '''
+        Complete the last word of the text typed by the user.
+
+        Inputs:
+        text: a string
+        limit: the maximum number of suggestions, at most MAX_LIMIT
+
+        Outputs:
+        a list of strings, the text with its last word completed
+        '''
+        text = text.lower()
+        words = WORD_RE.findall(text)
+        # Nothing to complete once the last word is followed by a space
+        if not words or not text.endswith(words[-1]):
+            return []
+        prefix = words[-1]
+        limit = min(limit, MAX_LIMIT)
+        if prefix in self.top:
+            indices = self.top[prefix][:limit]
+        else:
+            indices = self._complete(prefix, limit)
+        head = ' '.join(words[:-1])
+        return [(head + ' ' if head else '') + self.words[i]
+                for i in indices]
+
+    def memory_bytes(self):
+        '''
+        Returns the memory held by the structure, in bytes.
+        '''
+        size = sys.getsizeof(self.words) + sys.getsizeof(self.counts)
+        size += sum(sys.getsizeof(word) for word in self.words)
+        size += sys.getsizeof(self.top)
+        size += sum(sys.getsizeof(prefix) + sys.getsizeof(indices)
+                    for (prefix, indices) in self.top.items())
+        return size
+
+    def stats(self):
+        return {'words': len(self.words), 'bytes': self.memory_bytes()}
+
+
+_SUGGESTER = None
+_LOCK = threading.Lock()
+
+
+def get_suggester():
+    '''
+    Returns the Suggester, building it from the product table on first
+    use.
+    '''
+    global _SUGGESTER
+    with _LOCK:
+        if _SUGGESTER is None:
+            with search_items.POOL.connection() as conn:
+                _SUGGESTER = Suggester(conn)
+        return _SUGGESTER
+
+
+def clear():
+    '''
+    Drop the Suggester, e.g. after the database has been rebuilt.
+    '''
+    global _SUGGESTER
+    with _LOCK:
+        _SUGGESTER = None
@@ -0,0 +1,234 @@
+'''
+Benchmark of search_items.search on a reproducible mix of queries.
+
+Builds a fresh database from the committed csv files in BackEnd/Data with
+build_database.py, draws queries over every field of the search form, and
+reports the latency percentiles and throughput of every engine and of
+search_batch.
+The results of every engine are checked against the 'sql' engine.
+
+    python benchmark.py [--queries 500] [--seed 0] [--database FILE]
+
+With --database, an already built database is used instead.
+'''
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import build_database
+import search_items
+from ranking import SCORING_PROFILES
+
+
+DEFAULT_QUERIES = 500
+# Rows per page, as in the web interface
+PAGE_SIZE = 100
+# Queries run before timing an engine, to load its in-memory structures
+WARMUP_QUERIES = 20
+PERCENTILES = (50, 95, 99)
+
+# Labels offered by the search form
+LABELS = ['organic', 'vegan', 'dairy free', 'kosher']
+# Share of the queries using each field
+FIELD_RATES = {
+    'product_name': 0.5,
+    'fuzzy': 0.2,
+    'labels': 0.2,
+    'nutrient': 0.15,
+    'contains': 0.15,
+    'not_contain': 0.15,
+    'store_name': 0.2,
+    'zipcode': 0.2,
+    'distance': 0.5,
+    'nearest': 0.3,
+    'group_stores': 0.15,
+    'top_k': 0.1,
+}
+
+
+def use_database(filename):
+    '''
+    Point search_items at another database file.
+    '''
+    search_items.reload()
+    search_items.POOL = search_items.ConnectionPool(filename)
+
+
+def make_workload(conn, n, seed):
+    '''
+    Draw n searches, as (args_from_ui, options) pairs, from the words,
+    nutrient values, stores and zipcodes of the database.  The same seed
+    and database always give the same workload.
+    '''
+    rng = random.Random(seed)
+    name_words = [token for (token,) in conn.execute(
+        "SELECT token FROM name_token GROUP BY token "
+        "HAVING COUNT(*) >= 20 ORDER BY token")]
+    ingred_words = [token for (token,) in conn.execute(
+        "SELECT token FROM ingredient_token GROUP BY token "
+        "HAVING COUNT(*) >= 50 ORDER BY token")]
+    chains = [name for (name,) in conn.execute(
+        "SELECT DISTINCT name FROM store ORDER BY name")]
+    zipcodes = [str(zipcode) for (zipcode,) in conn.execute(
+        "SELECT DISTINCT zipcode FROM store WHERE zipcode IS NOT NULL "
+        "ORDER BY zipcode")]
+    # Caps are drawn among the deciles of each nutrient
+    deciles = {}
+    for (field, _) in search_items.NUTRIENT_FILTERS:
+        values = [value for (value,) in conn.execute(
+            "SELECT {0} FROM product WHERE {0} IS NOT NULL "
+            "ORDER BY {0}".format(field))]
+        deciles[field] = [values[len(values) * i // 10] for i in range(1, 10)]
+
+    workload = []
+    while len(workload) < n:
+        args = {}
+        if rng.random() < FIELD_RATES['product_name']:
+            args['product_name'] = ' '.join(
+                rng.sample(name_words, rng.choice((1, 1, 2))))
+            if rng.random() < FIELD_RATES['fuzzy']:
+                args['fuzzy'] = True
+        if rng.random() < FIELD_RATES['labels']:
+            args['labels'] = rng.sample(LABELS, rng.choice((1, 1, 2)))
+        for (field, _) in search_items.NUTRIENT_FILTERS:
+            if rng.random() < FIELD_RATES['nutrient']:
+                args[field] = float(rng.choice(deciles[field]))
+        if rng.random() < FIELD_RATES['contains']:
+            args['contains'] = rng.choice(ingred_words)
+        if rng.random() < FIELD_RATES['not_contain']:
+            args['not_contain'] = ' '.join(
+                rng.sample(ingred_words, rng.choice((1, 2))))
+        if rng.random() < FIELD_RATES['store_name']:
+            args['store_name'] = rng.sample(chains, rng.choice((1, 2)))
+        if rng.random() < FIELD_RATES['zipcode']:
+            args['zipcode'] = rng.choice(zipcodes)
+            if rng.random() < FIELD_RATES['distance']:
+                args['distance'] = float(rng.choice((1, 2, 5, 10)))
+            if rng.random() < FIELD_RATES['nearest']:
+                args['nearest'] = rng.choice((1, 3, 10))
+        if not args:
+            continue
+        options = {'page_size': PAGE_SIZE,
+                   'group_stores':
+                   rng.random() < FIELD_RATES['group_stores']}
+        if rng.random() < FIELD_RATES['top_k']:
+            options['top_k'] = rng.choice((5, 10, 50))
+            options['profile'] = rng.choice(sorted(SCORING_PROFILES))
+        workload.append((args, options))
+    return workload
+
+
+def percentile(sorted_values, p):
+    '''
+    Returns the p-th percentile of a sorted list, by nearest rank.
+    '''
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[rank - 1]
+
+
+def run_engine(workload, engine):
+    '''
+    Run every search of the workload with an engine.
+
+    Outputs:
+    the list of results and the list of latencies, in seconds
+    '''
+    for (args, options) in workload[:WARMUP_QUERIES]:
+        search_items.search(args, engine=engine, **options)
+    results = []
+    latencies = []
+    for (args, options) in workload:
+        start = time.perf_counter()
+        results.append(search_items.search(args, engine=engine, **options))
+        latencies.append(time.perf_counter() - start)
+    return (results, latencies)
+
+
+def run_batch(workload):
+    '''
+    Run the workload through search_batch, one batch per set of options.
+
+    Outputs:
+    the list of results, in workload order, and the elapsed time
+    '''
+    batches = {}
+    for (i, (args, options)) in enumerate(workload):
+        batches.setdefault(tuple(sorted(options.items())), []).append(i)
+    results = [None] * len(workload)
+    start = time.perf_counter()
+    for (options, indices) in batches.items():
+        for (i, res) in zip(indices, search_items.search_batch(
+                [workload[i][0] for i in indices], **dict(options))):
+            results[i] = res
+    return (results, time.perf_counter() - start)
+
+
+def same_result(res, expected):
+    '''
+    Whether two search results have the same header, rows, total and
+    next page.
+    '''
+    ((header, rows), (expected_header, expected_rows)) = (res, expected)
+    return (header == expected_header and list(rows) == list(expected_rows)
+            and getattr(rows, 'total', None) ==
+            getattr(expected_rows, 'total', None)
+            and getattr(rows, 'next_cursor', None) ==
+            getattr(expected_rows, 'next_cursor', None))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--queries', type=int, default=DEFAULT_QUERIES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database',
+                        help='use this database instead of building one')
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if options.database:
+            filename = options.database
+        else:
+            filename = os.path.join(directory, 'foodsearch.sqlite3')
+            timings = build_database.build(filename, verbose=False)
+            print('Built {} in {:.1f} s'.format(
+                filename, sum(seconds for (_, seconds) in timings)))
+        use_database(filename)
+        with search_items.POOL.connection() as conn:
+            workload = make_workload(conn, options.queries, options.seed)
+
+        print('{} queries, seed {}, latencies in ms'.format(
+            len(workload), options.seed))
+        print('{:<8}'.format('engine') +
+              ''.join('{:>9}'.format('p{}'.format(p)) for p in PERCENTILES) +
+              '{:>9}{:>12}'.format('qps', 'mismatches'))
+        expected = None
+        for engine in search_items.ENGINES + ('batch',):
+            if engine == 'batch':
+                (results, elapsed) = run_batch(workload)
+                latencies = None
+            else:
+                (results, latencies) = run_engine(workload, engine)
+                elapsed = sum(latencies)
+            if expected is None:
+                expected = results
+            mismatches = [args for ((args, _), res, expected_res) in
+                          zip(workload, results, expected)
+                          if not same_result(res, expected_res)]
+            percentiles = (
+                ''.join('{:>9.2f}'.format(
+                    percentile(sorted(latencies), p) * 1000)
+                    for p in PERCENTILES) if latencies else
+                ''.join('{:>9}'.format('-') for _ in PERCENTILES))
+            print('{:<8}{}{:>9.1f}{:>12}'.format(
+                engine, percentiles, len(workload) / elapsed,
+                len(mismatches)))
+            for args in mismatches[:3]:
+                print('    differs from sql:', args)
+        search_items.reload()
+
+
+if __name__ == '__main__':
+    main()
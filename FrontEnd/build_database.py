@@ -0,0 +1,203 @@
+'''
+Builds foodsearch.sqlite3 from the crawled csv files in one step.
+
+It does what DataCleaning.py, database.sql and search_index.py do in
+turn, without pandas or the sqlite3 shell: the csv files are read with
+the csv module, their values converted to numbers and NULLs as they are
+read, and the rows inserted with executemany in a single transaction.
+The indexes are created once the tables are loaded, then the search
+structures of search_index.py, and the statistics are gathered with
+ANALYZE.  The tables and indexes are those of BackEnd/DataBase/schema.sql
+and indexes.sql, which database.sql reads too.  The database is written
+to a temporary file renamed over the target when complete, so a server
+keeps reading the previous file until then.
+
+    python build_database.py [path/to/foodsearch.sqlite3]
+
+The time taken by every phase is printed.
+'''
+
+import csv
+import os
+import sqlite3
+import sys
+import time
+
+import search_index
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'BackEnd', 'Data')
+
+# The tables and indexes, defined once for this script and database.sql
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                          'BackEnd', 'DataBase')
+SCHEMA_FILE = os.path.join(SCHEMA_DIR, 'schema.sql')
+INDEXES_FILE = os.path.join(SCHEMA_DIR, 'indexes.sql')
+
+# Nothing is read before the file is renamed into place, so the load
+# needs neither a journal nor syncing
+LOAD_PRAGMAS = (
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+)
+
+PRODUCT_COLUMNS = ['name', 'ingred', 'calories', 'trans_fat', 'satu_fat',
+                   'tot_fat', 'sodium', 'cholesterol', 'tot_carhy',
+                   'diet_fiber', 'protein', 'sugars', 'labels', 'serv_size',
+                   'tot_ser', 'store']
+REAL_COLUMNS = {'calories', 'trans_fat', 'satu_fat', 'tot_fat', 'sodium',
+                'cholesterol', 'tot_carhy', 'diet_fiber', 'protein',
+                'sugars', 'tot_ser'}
+STORE_COLUMNS = ['name', 'address', 'city', 'state', 'zipcode']
+
+# The csv files of every chain, in the order of their rows in the tables,
+# with the table column of each csv column (None for those left out) and
+# the values of the columns they lack, as in DataCleaning.py
+PRODUCT_SOURCES = [
+    ('TJ_prod.csv',
+     [None, 'name', 'store', 'ingred', 'calories', 'trans_fat', 'tot_fat',
+      'satu_fat', 'sodium', 'cholesterol', 'tot_carhy', 'diet_fiber',
+      'protein', 'sugars', 'tot_ser', 'serv_size', 'labels'], {}),
+    ('WF_prod.csv',
+     [None, 'name', 'ingred', 'calories', 'trans_fat', 'satu_fat',
+      'tot_fat', 'sodium', 'cholesterol', 'tot_carhy', 'diet_fiber',
+      'protein', 'sugars', 'labels', 'serv_size', 'tot_ser', 'store'], {}),
+    ('JOSCO_prod.csv',
+     [None, None, 'name', 'ingred', 'serv_size', 'tot_ser', 'calories',
+      'tot_fat', 'satu_fat', 'trans_fat', 'tot_carhy', 'sugars', 'protein',
+      'sodium', 'diet_fiber', 'cholesterol', 'store', 'labels'], {}),
+]
+STORE_SOURCES = [
+    ('TJ_store.csv',
+     [None, 'name', 'address', 'city', 'state', 'zipcode'], {}),
+    ('WF_store.csv',
+     [None, 'address', 'city', 'state', 'zipcode'], {'name': 'Whole Foods'}),
+    ('JOSCO_store.csv',
+     ['zipcode', 'city', 'state', 'address', 'name', None], {}),
+]
+
+# The strings read as missing values, and stored as NULL, by pandas in
+# DataCleaning.py
+NULL_STRINGS = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN',
+                '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA',
+                'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'}
+
+
+def convert(column, value):
+    '''
+    Returns the value of a csv field for a table column: None for a
+    missing value, a float in REAL columns and the string otherwise.
+    '''
+    if value in NULL_STRINGS:
+        return None
+    if column in REAL_COLUMNS:
+        try:
+            return float(value)
+        except ValueError:
+            # Kept as text, as SQLite does with REAL affinity
+            return value
+    return value
+
+
+def read_rows(sources, columns, data_dir=DATA_DIR):
+    '''
+    Read the csv files of sources and generate their rows as tuples of
+    converted values in the order of columns, numbered from 0 like the
+    index written by DataCleaning.py.  Rows without a name are skipped.
+    '''
+    row_id = 0
+    for (filename, source_columns, constants) in sources:
+        with open(os.path.join(data_dir, filename), newline='') as f:
+            reader = csv.reader(f)
+            next(reader)
+            for fields in reader:
+                values = dict(constants)
+                for (column, value) in zip(source_columns, fields):
+                    if column is not None:
+                        values[column] = convert(column, value)
+                if values.get('name') is None:
+                    continue
+                yield (row_id,) + tuple(values.get(column)
+                                        for column in columns)
+                row_id += 1
+
+
+def read_script(filename):
+    '''
+    Returns the SQL statements of a file of BackEnd/DataBase.
+    '''
+    with open(filename) as f:
+        return f.read()
+
+
+def load_tables(conn, data_dir=DATA_DIR):
+    '''
+    Create the product and store tables and load them from the csv files
+    in a single transaction.
+
+    Outputs:
+    the numbers of products and stores
+    '''
+    conn.executescript(read_script(SCHEMA_FILE))
+    with conn:
+        products = conn.executemany(
+            "INSERT INTO product VALUES ({})".format(
+                ", ".join("?" * (len(PRODUCT_COLUMNS) + 1))),
+            read_rows(PRODUCT_SOURCES, PRODUCT_COLUMNS, data_dir)).rowcount
+        stores = conn.executemany(
+            "INSERT INTO store VALUES ({})".format(
+                ", ".join("?" * (len(STORE_COLUMNS) + 1))),
+            read_rows(STORE_SOURCES, STORE_COLUMNS, data_dir)).rowcount
+    return (products, stores)
+
+
+def build(filename=None, data_dir=DATA_DIR, verbose=True):
+    '''
+    Build a ready to serve database file from the csv files in data_dir.
+    filename defaults to the database used by search_items.
+
+    Outputs:
+    a list of (phase, seconds) pairs
+    '''
+    if filename is None:
+        from search_items import DATABASE_FILENAME
+        filename = DATABASE_FILENAME
+    building = filename + '.building'
+    if os.path.exists(building):
+        os.remove(building)
+    timings = []
+
+    def timed(phase, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append((phase, time.perf_counter() - start))
+        if verbose:
+            print('{:<24}{:>9.2f} s'.format(phase, timings[-1][1]))
+        return result
+
+    conn = sqlite3.connect(building)
+    try:
+        for pragma in LOAD_PRAGMAS:
+            conn.execute(pragma)
+        (products, stores) = timed('load tables', load_tables, conn,
+                                   data_dir)
+        if verbose:
+            print('    {} products, {} stores'.format(products, stores))
+        timed('create indexes', conn.executescript,
+              read_script(INDEXES_FILE))
+        for step in search_index.BUILD_STEPS:
+            timed(step.__name__, step, conn)
+        conn.commit()
+        timed('analyze', conn.executescript, "ANALYZE;")
+    finally:
+        conn.close()
+    os.replace(building, filename)
+    if verbose:
+        print('{:<24}{:>9.2f} s'.format(
+            'total', sum(seconds for (_, seconds) in timings)))
+    return timings
+
+
+if __name__ == '__main__':
+    build(*sys.argv[1:2])
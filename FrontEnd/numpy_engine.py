@@ -0,0 +1,395 @@
+'''
+In-memory query engine for search_items.search.
+
+The product table is loaded once into column-oriented NumPy arrays and the
+nutrient, label and store filters are evaluated as vectorized boolean
+masks.  Name and ingredient words still go through SQLite (and its
+full-text and ingredient indexes), and only the surviving products are
+joined with the stores of their chain.
+'''
+
+import threading
+
+import numpy as np
+
+import ranking
+import search_items
+import timing
+
+
+class ProductArrays:
+    '''
+    The product and store tables held in memory.
+
+    Nutrients are float32 arrays with NaN for NULL, so that comparisons
+    with NULL fail as they do in SQL; the original values are kept for
+    display.  label_mask is None when the database has no label index.
+    Products are also coded by their raw labels value, and
+    label_incidence tells which of label_names each value holds, so that
+    facets are counted with a bincount and a matrix product.
+    '''
+
+    def __init__(self, conn, tables):
+        has_mask = 'label' in tables
+        fields = [field for (field, _) in search_items.NUTRIENT_FILTERS]
+        columns = ["id", "name", "store", "labels"] + fields
+        if has_mask:
+            columns.append("label_mask")
+        rows = conn.execute("SELECT {} FROM product ORDER BY id".format(
+            ", ".join(columns))).fetchall()
+        values = dict(zip(columns, zip(*rows))) if rows else {
+            column: () for column in columns}
+
+        self.size = len(rows)
+        self.ids = np.array(values["id"], dtype=np.int64)
+        self.values = {column: values[column] for column in columns}
+        (self.chains, self.chain_codes) = np.unique(
+            np.array(values["store"], dtype=object).astype(str),
+            return_inverse=True)
+        (self.label_sets, self.label_codes) = np.unique(
+            np.array([labels or '' for labels in values["labels"]],
+                     dtype=object).astype(str),
+            return_inverse=True)
+        label_sets = [search_items.parse_labels(labels)
+                      for labels in self.label_sets]
+        self.label_names = sorted(set().union(*label_sets))
+        self.label_incidence = np.array(
+            [[label in labels for label in self.label_names]
+             for labels in label_sets], dtype=np.int64).reshape(
+                 len(label_sets), len(self.label_names))
+        # None becomes NaN when converted to a float array
+        self.nutrients = {
+            field: np.array(values[field], dtype=np.float32)
+            for field in fields}
+
+        self.label_mask = None
+        self.label_bits = {}
+        if has_mask:
+            self.label_mask = np.array(values["label_mask"], dtype=np.int64)
+            self.label_bits = dict(conn.execute("SELECT name, bit FROM label"))
+        self.stores = search_items.chain_stores(conn)
+
+
+_ARRAYS = None
+_LOCK = threading.Lock()
+
+
+def get_arrays(conn, tables):
+    '''
+    Returns the ProductArrays, loading them on first use.
+    '''
+    global _ARRAYS
+    with _LOCK:
+        if _ARRAYS is None:
+            _ARRAYS = ProductArrays(conn, tables)
+        return _ARRAYS
+
+
+def clear():
+    '''
+    Drop the loaded arrays, e.g. after the database has been rebuilt.
+    '''
+    global _ARRAYS
+    with _LOCK:
+        _ARRAYS = None
+
+
+def search(args_from_ui, conn, tables, page_size=None, cursor=None,
+           group_stores=False, nearby=None, top_k=None,
+           profile=ranking.DEFAULT_PROFILE, facets=False):
+    '''
+    Same contract as search_items.search: returns the header and the Page
+    of result rows, which holds one page when page_size is given.  Rows
+    come in product id, then store id (or distance) order, with one row per
+    product when group_stores is set.
+    '''
+    arrays = get_arrays(conn, tables)
+    selected = select_products(args_from_ui, conn, tables, arrays)
+    return search_selected(args_from_ui, arrays, selected, page_size, cursor,
+                           group_stores, nearby, top_k, profile, facets)
+
+
+def search_batch(args_list, conn, tables, nearby_list, page_size=None,
+                 group_stores=False, top_k=None,
+                 profile=ranking.DEFAULT_PROFILE, facets=False):
+    '''
+    Run several searches at once, returning the result of search for each
+    dictionary of args_list, whose stores nearby are in nearby_list.
+
+    Every search is evaluated on the same arrays, and a name, ingredient
+    or label condition shared by several searches goes to SQLite once.
+    '''
+    arrays = get_arrays(conn, tables)
+    sql_masks = {}
+    return [search_selected(args_from_ui, arrays,
+                            select_products(args_from_ui, conn, tables,
+                                            arrays, sql_masks),
+                            page_size, None, group_stores, nearby, top_k,
+                            profile, facets)
+            for (args_from_ui, nearby) in zip(args_list, nearby_list)]
+
+
+def select_products(args_from_ui, conn, tables, arrays, sql_masks=None):
+    '''
+    Returns the indices of the products matching the criteria, in id
+    order.  sql_masks, when given, keeps the mask of the products matched
+    by the SQLite query of each condition for later calls.
+    '''
+    mask = make_mask(args_from_ui, arrays)
+
+    # Remaining conditions on product columns run as one SQLite query
+    query, param = search_items.make_match_condition(
+        args_from_ui, tables, [], ())
+    query, param = search_items.make_exclude_condition(
+        args_from_ui, tables, query, param)
+    if args_from_ui.get('labels') and arrays.label_mask is None:
+        query, param = search_items.make_label_condition(
+            args_from_ui, tables, query, param)
+    if query:
+        if sql_masks is None:
+            sql_masks = {}
+        key = (tuple(query), tuple(param))
+        if key not in sql_masks:
+            ids = [product_id for (product_id,) in timing.fetch_all(
+                conn, "SELECT product.id FROM product WHERE " +
+                " AND ".join(query), param)]
+            sql_masks[key] = np.isin(arrays.ids, ids)
+        mask &= sql_masks[key]
+    return np.flatnonzero(mask)
+
+
+def search_selected(args_from_ui, arrays, selected, page_size=None,
+                    cursor=None, group_stores=False, nearby=None, top_k=None,
+                    profile=ranking.DEFAULT_PROFILE, facets=False):
+    '''
+    The rest of search, once the matching products are selected.
+    '''
+    columns = search_items.select_columns(args_from_ui, nearby)
+    header = [column.split(".")[1] for column in columns]
+    facet_counts = None
+    if facets:
+        facet_counts = count_facets(args_from_ui, arrays, selected,
+                                    group_stores, nearby)
+    if top_k is not None:
+        (header, rows) = search_ranked(args_from_ui, arrays, columns,
+                                       selected, top_k, profile,
+                                       group_stores, nearby)
+        return (header, search_items.Page(rows, None, len(rows),
+                                          facet_counts))
+    if page_size is None:
+        return (header, search_items.Page(
+            make_rows(args_from_ui, arrays, columns, selected,
+                      group_stores=group_stores, nearby=nearby),
+            None, None, facet_counts))
+
+    key_size = 1 if group_stores else 2
+    (after, total) = search_items.decode_cursor(cursor, key_size)
+    if facet_counts is not None:
+        total = sum(facet_counts['store_name'].values())
+    elif total is None:
+        total = count_rows(args_from_ui, arrays, selected, group_stores,
+                           nearby)
+    rows = make_rows(args_from_ui, arrays, columns, selected,
+                     after=after, limit=page_size + 1,
+                     group_stores=group_stores, nearby=nearby)
+    return (header, search_items.make_page(
+        rows, page_size, total, key_size=key_size,
+        facets=facet_counts))
+
+
+def search_ranked(args_from_ui, arrays, columns, selected, top_k, profile,
+                  group_stores=False, nearby=None):
+    '''
+    Keep the top_k best scored products among the selected ones.  Scores
+    are computed for all of them at once and only the best are sorted,
+    after a partial sort (np.partition) has found the k-th best score.
+    '''
+    per_chain = _stores_per_chain(arrays, args_from_ui, nearby)
+    selected = selected[per_chain[arrays.chain_codes[selected]] > 0]
+    terms = ranking.scoring_terms(args_from_ui, search_items.NUTRIENT_FILTERS,
+                                  profile)
+    scores = score_products(arrays, selected, terms)
+
+    if len(selected) > top_k:
+        kth = np.partition(scores, len(selected) - top_k)[
+            len(selected) - top_k]
+        # Ties with the k-th score are broken by product id below
+        keep = np.flatnonzero(scores >= kth)
+    else:
+        keep = np.arange(len(selected))
+    order = keep[np.lexsort((arrays.ids[selected[keep]], -scores[keep]))]
+    order = order[:top_k]
+
+    fields = [column.split(".")[1] for column in columns
+              if column.startswith("product.")]
+    best = [(float(scores[k]), int(arrays.ids[selected[k]]),
+             arrays.chains[arrays.chain_codes[selected[k]]],
+             {field: arrays.values[field][selected[k]] for field in fields})
+            for k in order]
+    return search_items.ranked_rows(best, columns, args_from_ui,
+                                    arrays.stores, group_stores, nearby)
+
+
+def score_products(arrays, selected, terms):
+    '''
+    Vectorized ranking.score of the selected products.
+    '''
+    if not terms:
+        return np.zeros(len(selected))
+    total = np.zeros(len(selected))
+    for (field, op, threshold, weight) in terms:
+        values = np.array([arrays.values[field][i] for i in selected],
+                          dtype=np.float64)
+        if op == '>=':
+            (high, low) = (values, threshold)
+        else:
+            (high, low) = (threshold, values)
+        denominator = high + low
+        fit = np.where(denominator == 0, 1.0,
+                       (high - low) / np.where(denominator == 0, 1,
+                                               denominator))
+        total += weight * fit
+    return total / sum(weight for (_, _, _, weight) in terms)
+
+
+def count_rows(args_from_ui, arrays, selected, group_stores=False,
+               nearby=None):
+    '''
+    Count the rows the selected products produce once joined with their
+    stores, without building them.
+    '''
+    per_chain = _stores_per_chain(arrays, args_from_ui, nearby)
+    if group_stores:
+        per_chain = np.minimum(per_chain, 1)
+    return int(per_chain[arrays.chain_codes[selected]].sum())
+
+
+def count_facets(args_from_ui, arrays, selected, group_stores=False,
+                 nearby=None):
+    '''
+    Facet counts (see search_items.tally_facets) of the rows the selected
+    products produce: the rows are added up per chain and per labels value
+    with bincounts, and the latter spread over labels by label_incidence.
+    '''
+    per_chain = _stores_per_chain(arrays, args_from_ui, nearby)
+    if group_stores:
+        per_chain = np.minimum(per_chain, 1)
+    rows = per_chain[arrays.chain_codes[selected]]
+    chain_counts = np.bincount(arrays.chain_codes[selected], weights=rows,
+                               minlength=len(arrays.chains))
+    set_counts = np.bincount(arrays.label_codes[selected], weights=rows,
+                             minlength=len(arrays.label_sets))
+    return search_items.facet_dict(
+        zip(arrays.chains.tolist(), chain_counts),
+        zip(arrays.label_names, set_counts @ arrays.label_incidence))
+
+
+def make_mask(args_from_ui, arrays):
+    '''
+    Evaluate the nutrient, label and store chain filters as one boolean
+    mask over the products.
+    '''
+    mask = np.ones(arrays.size, dtype=bool)
+
+    for (field, op) in search_items.NUTRIENT_FILTERS:
+        if field in args_from_ui:
+            column = arrays.nutrients[field]
+            threshold = np.float32(float(args_from_ui[field]))
+            if op == '<=':
+                mask &= column <= threshold
+            else:
+                mask &= column >= threshold
+
+    labels = search_items.requested_labels(args_from_ui)
+    if labels and arrays.label_mask is not None:
+        if not set(labels) <= arrays.label_bits.keys():
+            mask[:] = False
+        else:
+            bits = sum(1 << arrays.label_bits[label] for label in labels)
+            mask &= (arrays.label_mask & bits) == bits
+
+    if 'store_name' in args_from_ui:
+        codes = np.flatnonzero(np.isin(arrays.chains,
+                                       list(args_from_ui['store_name'])))
+        mask &= np.isin(arrays.chain_codes, codes)
+
+    return mask
+
+
+def make_rows(args_from_ui, arrays, columns, selected, after=None,
+              limit=None, group_stores=False, nearby=None):
+    '''
+    Join the selected products with the stores of their chain and
+    generate the result rows with the requested columns.  With
+    group_stores, the stores of a product are aggregated into a single
+    row.
+
+    For pagination, after is the key to start after and limit the maximum
+    number of rows; each row then ends with its key (product and store
+    ids or ranks, or only the product id), as expected by
+    search_items.make_page.
+    '''
+    # Within a product, stores are ordered by id or by distance
+    store_key = 'id' if nearby is None else 'rank'
+    if after is not None:
+        start = np.searchsorted(arrays.ids[selected], after[0],
+                                side='right' if group_stores else 'left')
+        selected = selected[start:]
+    # Once products without any matching store are dropped, each one
+    # yields at least one row
+    per_chain = _stores_per_chain(arrays, args_from_ui, nearby)
+    selected = selected[per_chain[arrays.chain_codes[selected]] > 0]
+    if limit is not None:
+        # The product of the key may have no rows left
+        selected = selected[:limit + 1]
+
+    product_values = {}
+    for column in columns:
+        (table, field) = column.split(".")
+        if table == "product":
+            values = arrays.values[field]
+            product_values[field] = [values[i] for i in selected]
+
+    count = 0
+    for (k, i) in enumerate(selected):
+        chain = arrays.chains[arrays.chain_codes[i]]
+        product_id = int(arrays.ids[i])
+        stores = search_items.matching_stores(
+            arrays.stores.get(chain, []), args_from_ui, nearby)
+        if group_stores:
+            row = [product_values[column.split(".")[1]][k]
+                   if column.startswith("product.") else
+                   search_items.group_store_column(column, chain, stores)
+                   for column in columns]
+            if limit is not None:
+                row.append(product_id)
+            yield tuple(row)
+            continue
+        for store in stores:
+            if after is not None and \
+                    (product_id, store[store_key]) <= after:
+                continue
+            row = []
+            for column in columns:
+                (table, field) = column.split(".")
+                if table == "product":
+                    row.append(product_values[field][k])
+                else:
+                    row.append(store[field])
+            if limit is not None:
+                row += [product_id, store[store_key]]
+            yield tuple(row)
+            count += 1
+            if count == limit:
+                return
+
+
+def _stores_per_chain(arrays, args_from_ui, nearby):
+    '''
+    Returns the number of matching stores of each chain, indexed like
+    arrays.chains.
+    '''
+    return np.array([
+        len(search_items.matching_stores(arrays.stores.get(chain, []),
+                                         args_from_ui, nearby))
+        for chain in arrays.chains], dtype=np.int64)
@@ -0,0 +1,95 @@
+'''
+Profiling of single search requests, for debugging a slow query in place.
+
+A view wrapped by profiled() runs under cProfile when the request has the
+cprofile parameter and the user may profile (settings.SEARCH_PROFILING,
+or a staff user).  Instead of the page, the response is a plain text
+report: the functions that took the most time, then every SQL query the
+search ran (see timing.fetch_all and fetch_rows) with its duration and
+the EXPLAIN QUERY PLAN of SQLite.  The search bypasses the result cache,
+so that its queries always run.
+'''
+
+import cProfile
+import io
+import pstats
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpResponse
+
+import search_items
+import timing
+
+
+# Number of functions listed in the report
+PROFILE_LIMIT = 40
+# Order of the functions: 'cumulative' or 'tottime'
+PROFILE_SORT = 'cumulative'
+
+
+def may_profile(request):
+    '''
+    Whether the request asks for a profile and is allowed one.
+    '''
+    if 'cprofile' not in request.GET:
+        return False
+    user = getattr(request, 'user', None)
+    return settings.SEARCH_PROFILING or bool(user and user.is_staff)
+
+
+def explain(conn, sql, params=()):
+    '''
+    Returns the EXPLAIN QUERY PLAN of a query, as indented lines.
+    '''
+    depth = {0: 0}
+    lines = []
+    for (node, parent, _, detail) in conn.execute(
+            "EXPLAIN QUERY PLAN " + sql, params):
+        depth[node] = depth.get(parent, 0) + 1
+        lines.append('  ' * depth[node] + detail)
+    return lines
+
+
+def report(profiler, timings):
+    '''
+    Returns the text report of a profiled request.
+
+    Inputs:
+    profiler: the cProfile.Profile of the request
+    timings: the timing.Timings of the request
+    '''
+    out = io.StringIO()
+    out.write('Total {:.2f} ms\nPhases (ms): {}\n\n'.format(
+        timings.elapsed() * 1000,
+        ', '.join('{} {:.2f}'.format(name, seconds * 1000)
+                  for (name, seconds) in timings.phases.items())))
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats(PROFILE_SORT).print_stats(PROFILE_LIMIT)
+
+    out.write('\n{} SQL queries\n'.format(len(timings.queries)))
+    with search_items.POOL.connection() as conn:
+        for (i, (sql, params, rows, seconds)) in enumerate(timings.queries):
+            out.write('\n#{} {:.2f} ms, {} rows\n{}\nparams: {!r}\n'.format(
+                i + 1, seconds * 1000, rows, sql, params))
+            out.write('\n'.join(explain(conn, sql, params)) + '\n')
+    return out.getvalue()
+
+
+def profiled(view):
+    '''
+    Run a view under cProfile and return the text report instead of its
+    response, when may_profile allows it.  The view runs with
+    request.profiling set, and must be wrapped by views.timed so that its
+    phases and queries are recorded.
+    '''
+    @wraps(view)
+    def profiled_view(request, *args, **kwargs):
+        if not may_profile(request):
+            return view(request, *args, **kwargs)
+        request.profiling = True
+        profiler = cProfile.Profile()
+        profiler.runcall(view, request, *args, **kwargs)
+        return HttpResponse(report(profiler, timing.current()),
+                            content_type='text/plain; charset=utf-8')
+    return profiled_view
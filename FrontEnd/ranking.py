@@ -0,0 +1,64 @@
+'''
+Scores how well a product fits the nutrient criteria of a search, for
+top-k ranked searches.
+
+Each nutrient the user filtered on contributes its relative margin:
+(cap - value) / (cap + value) under a cap, (value - floor) /
+(value + floor) over a floor.  Both lie between 0 (on the limit) and 1,
+and a scoring profile weighs them; the score is their weighted mean.
+'''
+
+
+# Weight of each nutrient under every profile; unlisted nutrients weigh 1
+SCORING_PROFILES = {
+    'balanced': {},
+    'low_calorie': {'calories': 3},
+    'low_sodium': {'sodium': 3},
+    'low_sugar': {'sugars': 3},
+    'high_protein': {'protein': 3},
+}
+DEFAULT_PROFILE = 'balanced'
+
+
+def scoring_terms(args_from_ui, nutrient_filters, profile=DEFAULT_PROFILE):
+    '''
+    Returns the (field, op, threshold, weight) terms of the score for the
+    nutrients in the search criteria.
+
+    Inputs:
+    args_from_ui: a dictionary, the search criteria
+    nutrient_filters: a list of (field, op) pairs, as in search_items
+    profile: a string, a key of SCORING_PROFILES
+    '''
+    if profile not in SCORING_PROFILES:
+        raise ValueError('unknown scoring profile: {}'.format(profile))
+    weights = SCORING_PROFILES[profile]
+    return [(field, op, float(args_from_ui[field]), weights.get(field, 1))
+            for (field, op) in nutrient_filters if field in args_from_ui]
+
+
+def fit(value, op, threshold):
+    '''
+    Returns the relative margin of a value over a floor (op '>=') or
+    under a cap (op '<=').
+    '''
+    if op == '>=':
+        (high, low) = (value, threshold)
+    else:
+        (high, low) = (threshold, value)
+    if high + low == 0:
+        return 1.0
+    return (high - low) / (high + low)
+
+
+def score(values, terms):
+    '''
+    Returns the score of a product given its nutrient values, a
+    dictionary from field to value.  Products are 0 without any term.
+    '''
+    if not terms:
+        return 0.0
+    total = 0.0
+    for (field, op, threshold, weight) in terms:
+        total += weight * fit(values[field], op, threshold)
+    return total / sum(weight for (_, _, _, weight) in terms)
@@ -0,0 +1,26 @@
+import sqlite3
+
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class SearchConfig(AppConfig):
+    name = 'search'
+
+    def ready(self):
+        # The warm-up is for deployments (SEARCH_MMAP).  Otherwise the
+        # database and the suggester are loaded on first use, and commands
+        # such as migrate or test never read them
+        if not settings.SEARCH_MMAP:
+            return
+        import autocomplete
+        import search_items
+        search_items.POOL.set_mapped(True)
+        try:
+            # Pay for cold pages and in-memory structures at startup, not
+            # on the first requests
+            search_items.warm_up(settings.SEARCH_ENGINE)
+            autocomplete.get_suggester()
+        except (sqlite3.Error, OSError):
+            # No database yet; it is loaded on first use instead
+            pass
@@ -1,3 +1,385 @@
-from django.test import TestCase
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+import autocomplete
+import benchmark
+import build_database
+import search_items
+import store_locator
+
+
+# Size and seed of the workload checked across engines
+WORKLOAD_QUERIES = 60
+WORKLOAD_SEED = 0
+# Paged searches are compared with unpaged ones up to this many rows, in
+# pages of PAGE_SIZE
+MAX_PAGED_ROWS = 2000
+PAGE_SIZE = 97
+
+
+class PageTests(SimpleTestCase):
+    '''
+    A Page built chunk by chunk holds the rows it was given.
+    '''
+    ROWS = [('a', 1.5, 1, None), ('a', None, 2, 'x'), ('b', 2.5, 3, None),
+            ('a', None, 2 ** 70, 'y'), ('a', 3.0, 5, None)]
+
+    def test_rows_survive_chunks(self):
+        for chunk in (1, 2, 100):
+            with self.subTest(chunk=chunk), \
+                    mock.patch.object(search_items, 'PAGE_CHUNK', chunk):
+                page = search_items.Page(iter(self.ROWS), None, None)
+                self.assertEqual(list(page), self.ROWS)
+                self.assertEqual([page[i] for i in range(len(page))],
+                                 self.ROWS)
+                self.assertEqual(page[1:4], self.ROWS[1:4])
+                self.assertEqual(page.column(1), [1.5, None, 2.5, None, 3.0])
+                self.assertEqual(page.total, len(self.ROWS))
+
+    def test_columns_are_compact(self):
+        page = search_items.Page(
+            [('Whole Foods', float(i), i) for i in range(10)], None, 10)
+        (names, values, ids) = page.columns
+        self.assertEqual(values.typecode, 'd')
+        self.assertEqual(ids.typecode, 'q')
+        self.assertIs(names[0], names[9])
+
+    def test_make_page_keeps_key_of_last_row(self):
+        rows = [('x', None, i, i * 10) for i in range(4)]
+        page = search_items.make_page(rows, 3, 100)
+        self.assertEqual(list(page), [('x', None)] * 3)
+        self.assertEqual(search_items.decode_cursor(page.next_cursor, 2),
+                         ((2, 20), 100))
+
+    def test_rows_of_different_lengths_are_refused(self):
+        with self.assertRaises(ValueError):
+            search_items.Page([(1, 2), (1,)], None, 2)
+
+
+class StartupTests(SimpleTestCase):
+    '''
+    The database is only read at startup when serving with SEARCH_MMAP.
+    '''
+
+    def test_nothing_loaded_without_mmap(self):
+        with override_settings(SEARCH_MMAP=False), \
+                mock.patch.object(search_items, 'warm_up') as warm_up, \
+                mock.patch.object(autocomplete, 'get_suggester') as suggester:
+            apps.get_app_config('search').ready()
+        warm_up.assert_not_called()
+        suggester.assert_not_called()
+
+
+class SearchDatabaseTestCase(TestCase):
+    '''
+    Runs its tests on a database built once from the csv files in
+    BackEnd/Data with build_database.build, in a temporary directory.
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        cls.filename = os.path.join(cls.directory, 'foodsearch.sqlite3')
+        build_database.build(cls.filename, verbose=False)
+        cls.pool = search_items.POOL
+        benchmark.use_database(cls.filename)
+
+    @classmethod
+    def tearDownClass(cls):
+        search_items.POOL.close()
+        search_items.reload()
+        search_items.POOL = cls.pool
+        shutil.rmtree(cls.directory)
+        super().tearDownClass()
+
+
+class EngineTests(SearchDatabaseTestCase):
+    '''
+    The numpy engine and search_batch return what the sql engine returns
+    on the benchmark workload.
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with search_items.POOL.connection() as conn:
+            cls.workload = benchmark.make_workload(
+                conn, WORKLOAD_QUERIES, WORKLOAD_SEED)
+
+    def test_engines_agree(self):
+        (expected, _) = benchmark.run_engine(self.workload, 'sql')
+        (results, _) = benchmark.run_engine(self.workload, 'numpy')
+        for ((args, options), res, expected_res) in zip(
+                self.workload, results, expected):
+            with self.subTest(args=args, options=options):
+                self.assertTrue(benchmark.same_result(res, expected_res))
+
+    def test_batch_agrees(self):
+        (expected, _) = benchmark.run_engine(self.workload, 'sql')
+        (results, _) = benchmark.run_batch(self.workload)
+        for ((args, options), res, expected_res) in zip(
+                self.workload, results, expected):
+            with self.subTest(args=args, options=options):
+                self.assertTrue(benchmark.same_result(res, expected_res))
+
+    def test_pages_add_up_to_unpaged_search(self):
+        checked = 0
+        for (args, options) in self.workload:
+            group_stores = options['group_stores']
+            (_, expected) = search_items.search(args,
+                                                group_stores=group_stores)
+            if 'top_k' in options or len(expected) > MAX_PAGED_ROWS:
+                continue
+            checked += 1
+            for engine in search_items.ENGINES:
+                with self.subTest(args=args, engine=engine):
+                    rows = []
+                    cursor = None
+                    while True:
+                        (_, page) = search_items.search(
+                            args, engine=engine, page_size=PAGE_SIZE,
+                            cursor=cursor, group_stores=group_stores)
+                        rows += page
+                        cursor = page.next_cursor
+                        if cursor is None:
+                            break
+                    self.assertEqual(page.total, len(expected))
+                    self.assertEqual(sorted(rows, key=repr),
+                                     sorted(expected, key=repr))
+        self.assertGreater(checked, 0)
+
+
+class ConnectionPoolTests(SearchDatabaseTestCase):
+    '''
+    Closing the pool leaves the connections in use open until they are
+    handed back.
+    '''
+
+    def test_close_spares_borrowed_connections(self):
+        pool = search_items.POOL
+        with pool.connection() as first, pool.connection() as second:
+            pass
+        with pool.connection() as conn:
+            idle = second if conn is first else first
+            pool.close()
+            (count,) = conn.execute("SELECT COUNT(*) FROM product").fetchone()
+            self.assertGreater(count, 0)
+        for closed in (idle, conn):
+            with self.assertRaises(sqlite3.ProgrammingError):
+                closed.execute("SELECT 1")
+        with pool.connection() as reopened:
+            self.assertNotIn(reopened, (first, second))
+            reopened.execute("SELECT 1")
+
+
+class CursorTests(SearchDatabaseTestCase):
+    '''
+    A page cursor continues the search it was made for, and is refused by
+    a search keyed differently.
+    '''
+    ARGS = {'product_name': 'yogurt'}
+
+    def test_cursor_continues_search(self):
+        for engine in search_items.ENGINES:
+            for group_stores in (False, True):
+                with self.subTest(engine=engine, group_stores=group_stores):
+                    (_, first) = search_items.search(
+                        self.ARGS, engine=engine, page_size=10,
+                        group_stores=group_stores)
+                    (_, second) = search_items.search(
+                        self.ARGS, engine=engine, page_size=10,
+                        cursor=first.next_cursor, group_stores=group_stores)
+                    (_, both) = search_items.search(
+                        self.ARGS, engine=engine, page_size=20,
+                        group_stores=group_stores)
+                    self.assertEqual(list(first) + list(second), list(both))
+                    self.assertEqual(second.total, first.total)
+
+    def test_cursor_of_other_key_size_is_invalid(self):
+        cursors = {group_stores: search_items.encode_cursor(
+                       (5,) if group_stores else (5, 1), 100)
+                   for group_stores in (False, True)}
+        for engine in search_items.ENGINES:
+            for group_stores in (False, True):
+                with self.subTest(engine=engine, group_stores=group_stores):
+                    with self.assertRaises(ValueError):
+                        search_items.search(
+                            self.ARGS, engine=engine, page_size=10,
+                            cursor=cursors[not group_stores],
+                            group_stores=group_stores)
+
+    def test_api_refuses_cursor_of_other_key_size(self):
+        response = self.client.get(reverse('search_api'), {
+            'product_name': 'yogurt',
+            'cursor': search_items.encode_cursor((5,), 100)})
+        self.assertEqual(response.status_code, 400)
+        (error,) = response.json()['errors']['__all__']
+        self.assertIn('invalid cursor', error['message'])
+
+    def test_home_escapes_invalid_cursor(self):
+        response = self.client.get(reverse('home'), {
+            'product_name': 'milk',
+            'cursor': '<script>alert(1)</script>'})
+        self.assertContains(response, 'invalid cursor')
+        self.assertNotContains(response, '<script>alert(1)</script>')
+
+
+class ConditionalSearchTests(SearchDatabaseTestCase):
+    '''
+    Searches are revalidated by an ETag of the request as sent, since the
+    response echoes the criteria as typed.
+    '''
+
+    def test_etag_follows_request(self):
+        url = reverse('search_api')
+        response = self.client.get(url, {'product_name': 'yogurt'})
+        etag = response['ETag']
+        self.assertEqual(self.client.get(
+            url, {'product_name': 'yogurt'},
+            HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        for criteria in ({'product_name': 'Yogurt'},
+                         {'product_name': ' yogurt '}):
+            with self.subTest(criteria=criteria):
+                response = self.client.get(url, criteria,
+                                           HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response['ETag'], etag)
+
+
+class LabelTests(SearchDatabaseTestCase):
+    '''
+    The empty "No preference" label of the form filters nothing.
+    '''
+
+    def test_empty_label_is_ignored(self):
+        for engine in search_items.ENGINES:
+            with self.subTest(engine=engine):
+                (_, everything) = search_items.search(
+                    {'product_name': 'soup'}, engine=engine)
+                (_, vegan) = search_items.search(
+                    {'product_name': 'soup', 'labels': ['vegan']},
+                    engine=engine)
+                (_, no_preference) = search_items.search(
+                    {'product_name': 'soup', 'labels': ['']}, engine=engine)
+                (_, both) = search_items.search(
+                    {'product_name': 'soup', 'labels': ['', 'vegan']},
+                    engine=engine)
+                self.assertTrue(vegan)
+                self.assertLess(len(vegan), len(everything))
+                self.assertEqual(no_preference, everything)
+                self.assertEqual(both, vegan)
+
+
+class StoreLocatorTests(SearchDatabaseTestCase):
+    '''
+    The grid finds the stores a scan of every store location finds, and
+    the search keeps only the stores nearest to the zipcode.
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with search_items.POOL.connection() as conn:
+            (cls.zipcode, latitude, longitude) = conn.execute(
+                "SELECT zipcode, latitude, longitude FROM zipcode "
+                "WHERE zipcode IN (SELECT zipcode FROM store) "
+                "ORDER BY zipcode LIMIT 1").fetchone()
+            cls.centroid = (latitude, longitude)
+            cls.scan = sorted(
+                (store_locator.haversine(latitude, longitude, lat, lon),
+                 store_id) for (store_id, lat, lon) in conn.execute(
+                    "SELECT store_id, latitude, longitude "
+                    "FROM store_location"))
+            cls.grid = store_locator.StoreGrid(conn)
+
+    def test_grid_matches_scan(self):
+        for k in (1, 10, 100):
+            with self.subTest(k=k):
+                self.assertEqual(
+                    self.grid.nearest(*self.centroid, k=k),
+                    [(store_id, distance)
+                     for (distance, store_id) in self.scan[:k]])
+        for radius in (1.0, 5.0, 20.0):
+            with self.subTest(radius=radius):
+                self.assertEqual(
+                    self.grid.nearest(*self.centroid, radius=radius),
+                    [(store_id, distance)
+                     for (distance, store_id) in self.scan
+                     if distance <= radius])
+
+    def test_search_keeps_nearest_stores(self):
+        args = {'product_name': 'milk', 'zipcode': str(self.zipcode),
+                'nearest': 3}
+        with search_items.POOL.connection() as conn:
+            nearby = store_locator.find_nearby(conn, args,
+                                               search_items.POOL.tables)
+            addresses = {address for (address,) in conn.execute(
+                "SELECT address FROM store WHERE id IN ({})".format(
+                    ', '.join('?' * len(nearby))), tuple(nearby))}
+        self.assertEqual(list(nearby), [store_id for (_, store_id)
+                                        in self.scan[:3]])
+        for engine in search_items.ENGINES:
+            with self.subTest(engine=engine):
+                (header, rows) = search_items.search(args, engine=engine)
+                self.assertTrue(rows)
+                self.assertLessEqual(
+                    {row[header.index('address')] for row in rows},
+                    addresses)
+        response = self.client.get(reverse('search_api'), args)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(
+            set(response.json()['data'][header.index('address')]),
+            addresses)
+
+
+class IngredientExclusionTests(SearchDatabaseTestCase):
+    '''
+    "Do Not Contain" excludes the products listing the word in the
+    singular or the plural.
+    '''
+
+    def assert_excluded(self, word, pattern, product_name):
+        args = {'not_contain': word, 'product_name': product_name}
+        for engine in search_items.ENGINES:
+            (header, rows) = search_items.search(args, engine=engine,
+                                                 group_stores=True)
+            self.assertTrue(rows)
+            for row in rows:
+                details = search_items.product_details(
+                    row[header.index('id')])
+                self.assertNotRegex(details['ingred'].lower(), pattern)
+
+    def test_singular_excludes_ies_plural(self):
+        self.assert_excluded('cookie', r'\bcookies?\b', 'cookies')
+        self.assert_excluded('brownie', r'\bbrownies?\b', 'brownies')
+
+    def test_plural_excludes_singular(self):
+        self.assert_excluded('cookies', r'\bcookies?\b', 'cookies')
+        self.assert_excluded('oats', r'\boats?\b', 'granola')
+
+
+class ProductDetailTests(SearchDatabaseTestCase):
+    '''
+    A product page lists the canonical labels of the product.
+    '''
+
+    def test_labels_are_listed(self):
+        with search_items.POOL.connection() as conn:
+            (product_id,) = conn.execute(
+                "SELECT id FROM product WHERE labels LIKE '%vegan%' "
+                "ORDER BY id LIMIT 1").fetchone()
+        details = search_items.product_details(product_id)
+        self.assertIn('vegan', details['labels'])
+        self.assertEqual(details['labels'], sorted(details['labels']))
+        response = self.client.get(reverse('product_detail',
+                                           args=[product_id]))
+        self.assertContains(response, '<li>vegan</li>', html=True)
+        self.assertNotContains(response, '{')
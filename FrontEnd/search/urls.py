@@ -4,4 +4,13 @@ from . import views
 
 urlpatterns = [
     path('', views.home, name='home'),
+    path('api/search', views.search_api, name='search_api'),
+    path('api/autocomplete', views.autocomplete_api, name='autocomplete_api'),
+    path('api/batch', views.search_batch_api, name='search_batch_api'),
+    path('api/async/search', views.search_api_async,
+         name='search_api_async'),
+    path('product/<int:product_id>', views.product_detail,
+         name='product_detail'),
+    path('api/product/<int:product_id>', views.product_api,
+         name='product_api'),
 ]
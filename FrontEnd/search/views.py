@@ -1,25 +1,62 @@
+import asyncio
+import hashlib
 import json
 import traceback
 import sys
 import csv
 import os
 
-from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial, reduce, wraps
 from operator import and_
 
+from django.conf import settings
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils.html import escape
+from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_POST
 from django import forms
 
-from search_items import search
+import autocomplete
+import search_items
+import timing
+from profiling import profiled
+from ranking import DEFAULT_PROFILE, SCORING_PROFILES
+from search_cache import (CACHE, cached_product_details,
+                          cached_search, cached_search_batch,
+                          database_generation)
+from search_items import POOL_SIZE, Page
 
 NOPREF_STR = 'No preference'
+# Number of result rows shown per page
+PAGE_SIZE = 100
+# Number of result rows rendered per chunk of a streamed page
+STREAM_ROWS = 50
+# Where index.html and results.html leave out the results and their rows
+# when streamed
+RESULTS_MARKER = '<!--results-->'
+ROWS_MARKER = '<!--rows-->'
+# Maximum number of searches in one request to search_batch_api
+MAX_BATCH = 100
 RES_DIR = os.path.join(os.path.dirname(__file__), '..', 'res')
 COLUMN_NAMES = dict(
     stores='Stores',
     product_name="Product Name",
     store_address="Store Address",
-    ingredients="ingredients"
+    id="Ingredients"
 )
+# Labels of the nutrients shown by the product detail page
+DETAIL_NUTRIENTS = [
+    ('calories', 'Calories'), ('tot_fat', 'Total Fat (g)'),
+    ('satu_fat', 'Saturated Fat (g)'), ('trans_fat', 'Trans Fat (g)'),
+    ('cholesterol', 'Cholesterol (mg)'), ('sodium', 'Sodium (mg)'),
+    ('tot_carhy', 'Total Carbohydrate (g)'),
+    ('diet_fiber', 'Dietary Fiber (g)'), ('sugars', 'Sugars (g)'),
+    ('protein', 'Protein (g)')]
 
 
 def _valid_result(res):
@@ -28,11 +65,14 @@ def _valid_result(res):
     ok = (isinstance(res, (tuple, list)) and
           len(res) == 2 and
           isinstance(res[HEADER], (tuple, list)) and
-          isinstance(res[RESULTS], (tuple, list)))
+          isinstance(res[RESULTS], (tuple, list, Page)))
     if not ok:
         return False
 
     n = len(res[HEADER])
+    # A Page checks the length of its rows when it is built
+    if isinstance(res[RESULTS], Page):
+        return not res[RESULTS] or res[RESULTS].width == n
 
     def _valid_row(row):
         return isinstance(row, (tuple, list)) and len(row) == n
@@ -41,6 +81,10 @@ def _valid_result(res):
 
 STORS = [('', NOPREF_STR), ('Whole Foods', 'Whole Foods'),
          ('Jewel Osco', 'Jewel Osco'), ('Trader Joes', 'Trader Joes')]
+NUTRIENT_FIELDS = ['calories', 'trans_fat', 'tot_fat', 'sodium',
+                   'tot_carhy', 'protein', 'sugars']
+PROFILES = [(profile, profile.replace('_', ' ').capitalize())
+            for profile in SCORING_PROFILES]
 LABELS = [('', NOPREF_STR), ('organic', 'Organic'), ('vegan', 'Vegan'),
           ('dairy free', 'Dairy Free'), ('kosher', 'Kosher')]
 
@@ -49,17 +93,24 @@ class SearchForm(forms.Form):
     product_name = forms.CharField(label='Search item names:',
                                    help_text='e.g. Yogurt',
                                    required=False)
+    fuzzy = forms.BooleanField(label='Tolerate typos', required=False)
     stores = forms.MultipleChoiceField(label='Stores', choices=STORS,
                                        widget=forms.CheckboxSelectMultiple,
                                        required=False)
-    calories = forms.CharField(label='Calories <=', required=False)
-    tot_fat = forms.CharField(label='Total Fat (g) <=', required=False)
-    trans_fat = forms.CharField(label='Trans Fat (g) <=', required=False)
-    sodium = forms.CharField(label='Sodium (mg) <=', required=False)
-    tot_carhy = forms.CharField(
-        label='Total Carbhydrate (g) <=', required=False)
-    protein = forms.CharField(label='Protein (g) >=', required=False)
-    sugars = forms.CharField(label='Sugars (g) <=', required=False)
+    calories = forms.FloatField(label='Calories <=', min_value=0,
+                                required=False)
+    tot_fat = forms.FloatField(label='Total Fat (g) <=', min_value=0,
+                               required=False)
+    trans_fat = forms.FloatField(label='Trans Fat (g) <=', min_value=0,
+                                 required=False)
+    sodium = forms.FloatField(label='Sodium (mg) <=', min_value=0,
+                              required=False)
+    tot_carhy = forms.FloatField(
+        label='Total Carbhydrate (g) <=', min_value=0, required=False)
+    protein = forms.FloatField(label='Protein (g) >=', min_value=0,
+                               required=False)
+    sugars = forms.FloatField(label='Sugars (g) <=', min_value=0,
+                              required=False)
     labels = forms.MultipleChoiceField(label='Dietary Restrictions', choices=LABELS,
                                        widget=forms.CheckboxSelectMultiple,
                                        required=False)
@@ -72,84 +123,455 @@ class SearchForm(forms.Form):
     zipcode = forms.CharField(label='Zipcode:',
                               help_text='To find stores nearby, please enter your zipcode',
                               required=False)
+    distance = forms.FloatField(label='Within (miles):', min_value=0,
+                                help_text='Distance from your zipcode, 5 by default',
+                                required=False)
+    nearest = forms.IntegerField(label='Nearest stores:', min_value=1,
+                                 max_value=1000,
+                                 help_text='Only the stores closest to your zipcode',
+                                 required=False)
+    group_stores = forms.BooleanField(label='One row per product',
+                                      required=False)
+    top_k = forms.IntegerField(label='Best matches only:', min_value=1,
+                               max_value=1000,
+                               help_text='Rank products by how well they fit the nutrient limits',
+                               required=False)
+    profile = forms.ChoiceField(label='Ranking', choices=PROFILES,
+                                required=False)
     show_args = forms.BooleanField(label='Show args_to_ui', required=False)
 
 
-def home(request):
-    context = {}
-    res = None
-    if request.method == 'GET':
-        # create a form instance and populate it with data from the request:
-        form = SearchForm(request.GET)
-        # check whether it's valid:
-        if form.is_valid():
+def form_args(form):
+    '''
+    Convert the data of a valid SearchForm to an args dictionary for search.
+    '''
+    args = {}
+    if form.cleaned_data['product_name']:
+        args['product_name'] = form.cleaned_data['product_name']
+    if form.cleaned_data['fuzzy']:
+        args['fuzzy'] = True
+    if form.cleaned_data['stores']:
+        args['store_name'] = form.cleaned_data['stores']
+    # Nutrient caps are floats; 0 is a valid cap
+    for field in NUTRIENT_FIELDS:
+        if form.cleaned_data[field] is not None:
+            args[field] = form.cleaned_data[field]
+    if form.cleaned_data['labels']:
+        args['labels'] = form.cleaned_data['labels']
+    if form.cleaned_data['contains']:
+        args['contains'] = form.cleaned_data['contains']
+    if form.cleaned_data['not_contain']:
+        args['not_contain'] = form.cleaned_data['not_contain']
+    if form.cleaned_data['zipcode']:
+        args['zipcode'] = str(form.cleaned_data['zipcode'])
+    if form.cleaned_data['distance'] is not None:
+        args['distance'] = form.cleaned_data['distance']
+    if form.cleaned_data['nearest'] is not None:
+        args['nearest'] = form.cleaned_data['nearest']
+    return args
 
-            # Convert form data to an args dictionary for search
-            args = {}
-            if form.cleaned_data['product_name']:
-                args['product_name'] = form.cleaned_data['product_name']
-            if form.cleaned_data['stores']:
-                args['store_name'] = form.cleaned_data['stores']
-            if form.cleaned_data['calories']:
-                args['calories'] = form.cleaned_data['calories']
-            if form.cleaned_data['trans_fat']:
-                args['trans_fat'] = form.cleaned_data['trans_fat']
-            if form.cleaned_data['tot_fat']:
-                args['tot_fat'] = form.cleaned_data['tot_fat']
-            if form.cleaned_data['sodium']:
-                args['sodium'] = form.cleaned_data['sodium']
-            if form.cleaned_data['tot_carhy']:
-                args['tot_carhy'] = form.cleaned_data['tot_carhy']
-            if form.cleaned_data['protein']:
-                args['protein'] = form.cleaned_data['protein']
-            if form.cleaned_data['sugars']:
-                args['sugars'] = form.cleaned_data['sugars']
-            if form.cleaned_data['labels']:
-                args['labels'] = form.cleaned_data['labels']
-            if form.cleaned_data['contains']:
-                args['contains'] = form.cleaned_data['contains']
-            if form.cleaned_data['not_contain']:
-                args['not_contain'] = form.cleaned_data['not_contain']
-            if form.cleaned_data['zipcode']:
-                args['zipcode'] = str(form.cleaned_data['zipcode'])
-            if form.cleaned_data['show_args']:
-                context['args'] = 'args_to_ui = ' + json.dumps(args, indent=2)
-
-            try:
-                res = search(args)
-            except Exception as e:
-                print('Exception caught')
-                bt = traceback.format_exception(*sys.exc_info()[:3])
-                context['err'] = """
+
+def form_options(form):
+    '''
+    Returns the options of search given by a valid SearchForm.
+    '''
+    return dict(page_size=PAGE_SIZE,
+                group_stores=form.cleaned_data['group_stores'],
+                top_k=form.cleaned_data['top_k'],
+                profile=form.cleaned_data['profile'] or DEFAULT_PROFILE,
+                facets=True)
+
+
+def request_form(request):
+    '''
+    Returns the SearchForm of the GET parameters of a request, validated
+    once per request.
+    '''
+    if not hasattr(request, 'search_form'):
+        with timing.phase('form'):
+            request.search_form = SearchForm(request.GET)
+            request.search_form.is_valid()
+    return request.search_form
+
+
+def search_etag(request):
+    '''
+    Returns the ETag of a search response: a hash of the generation of the
+    database build and the full path of the request, which identify its
+    content byte for byte (the response echoes the criteria as typed).
+    None, for no ETag, when the form is invalid, with show_args or a
+    profile, and for a database without a build stamp.
+    '''
+    generation = database_generation()
+    if generation is None or 'cprofile' in request.GET:
+        return None
+    form = request_form(request)
+    if not form.is_valid() or form.cleaned_data['show_args']:
+        return None
+    return hashlib.sha1(repr((generation[0], request.get_full_path()))
+                        .encode()).hexdigest()
+
+
+def search_last_modified(request):
+    '''
+    Returns the build time of the database, for the responses that have
+    an ETag.
+    '''
+    if search_etag(request) is None:
+        return None
+    return datetime.fromtimestamp(database_generation()[1], timezone.utc)
+
+
+def conditional(view):
+    '''
+    Give the responses of a search view an ETag and a Last-Modified date
+    (see search_etag), answer the matching conditional GETs with 304 Not
+    Modified before any search runs, and make browsers and proxies
+    revalidate cached responses, which only change with the database.
+    '''
+    return cache_control(no_cache=True)(
+        condition(etag_func=search_etag,
+                  last_modified_func=search_last_modified)(view))
+
+
+def run_search(request, form, args):
+    '''
+    Run the search for the args of a valid SearchForm, with the page given
+    by the cursor parameter of the request.  Profiled requests (see
+    profiling.py) skip the cache.
+    '''
+    if getattr(request, 'profiling', False):
+        return search_items.search(args, engine=settings.SEARCH_ENGINE,
+                                   cursor=request.GET.get('cursor'),
+                                   **form_options(form))
+    return cached_search(args, engine=settings.SEARCH_ENGINE,
+                         cursor=request.GET.get('cursor'),
+                         **form_options(form))
+
+
+def timed(view):
+    '''
+    Record the phase timings of a view, send them back in the
+    Server-Timing header and log the requests taking at least
+    settings.SLOW_SEARCH_MS milliseconds.
+    '''
+    @wraps(view)
+    def timed_view(request, *args, **kwargs):
+        with timing.record() as timings:
+            response = view(request, *args, **kwargs)
+        response['Server-Timing'] = timings.server_timing()
+        timings.log_if_slow(settings.SLOW_SEARCH_MS, path=request.path,
+                            query=request.GET.urlencode())
+        return response
+    return timed_view
+
+
+def search_result(request, form, args):
+    '''
+    Run the search of home for the args of a valid SearchForm.
+
+    Outputs:
+    the result of search, or None, and the error message to show, or None
+    '''
+    try:
+        with timing.phase('search'):
+            return (run_search(request, form, args), None)
+    except ValueError as e:
+        # Invalid parameters, such as a mangled cursor
+        return (None, 'Invalid search: {}'.format(escape(e)))
+    except Exception as e:
+        print('Exception caught')
+        bt = traceback.format_exception(*sys.exc_info()[:3])
+        return (None, """
                 An exception was thrown in search:
                 <pre>{}
 {}</pre>
-                """.format(e, '\n'.join(bt))
+                """.format(escape(e), escape('\n'.join(bt))))
 
-                res = None
-    else:
-        form = SearchForm()
 
+def result_context(request, res):
+    '''
+    Returns the template context showing the result of search, or what is
+    wrong with it.
+    '''
+    context = {}
     # Handle different responses of res
+    with timing.phase('validate'):
+        valid = res is not None and not isinstance(res, str) and \
+            _valid_result(res)
     if res is None:
         context['result'] = None
     elif isinstance(res, str):
         context['result'] = None
         context['err'] = res
-        result = None
-    elif not _valid_result(res):
+    elif not valid:
         context['result'] = None
         context['err'] = ('Return of search has the wrong data type. ')
     else:
         columns, result = res
 
         # Wrap in tuple if result is not already
-        if result and isinstance(result[0], str):
+        if result and not isinstance(result, Page) and \
+                isinstance(result[0], str):
             result = [(r,) for r in result]
 
         context['result'] = result
-        context['num_results'] = len(result)
+        context['num_results'] = getattr(result, 'total', len(result))
+        facets = getattr(result, 'facets', None)
+        if facets:
+            context['facets'] = [
+                ' / '.join('{} ({})'.format(name, count)
+                           for (name, count) in counts.items())
+                for counts in facets.values() if counts]
+        if getattr(result, 'next_cursor', None):
+            params = request.GET.copy()
+            params['cursor'] = result.next_cursor
+            context['next_page'] = '?' + params.urlencode()
         context['columns'] = [COLUMN_NAMES.get(col, col) for col in columns]
+        # Product ids are shown as links to the product details
+        if 'id' in columns:
+            context['detail_column'] = columns.index('id')
+    return context
+
+
+@timed
+@conditional
+@profiled
+def home(request):
+    context = {}
+    res = None
+    valid = False
+    if request.method == 'GET':
+        # create a form instance and populate it with data from the request:
+        form = request_form(request)
+        # check whether it's valid:
+        valid = form.is_valid()
+        if valid:
 
+            # Convert form data to an args dictionary for search
+            args = form_args(form)
+            if form.cleaned_data['show_args']:
+                context['args'] = ('args_to_ui = ' +
+                                   json.dumps(args, indent=2) +
+                                   '\nsearch cache = ' +
+                                   json.dumps(CACHE.stats()) +
+                                   '\nautocomplete = ' +
+                                   json.dumps(autocomplete.get_suggester()
+                                              .stats()))
+    else:
+        form = SearchForm()
     context['form'] = form
-    return render(request, 'index.html', context)
+
+    if valid and settings.SEARCH_STREAM and \
+            not getattr(request, 'profiling', False):
+        context['stream'] = True
+        with timing.phase('render'):
+            page = render_to_string('index.html', context, request)
+        return StreamingHttpResponse(
+            stream_page(request, form, args, context, page))
+
+    if valid:
+        (res, context['err']) = search_result(request, form, args)
+    context.update(result_context(request, res))
+    with timing.phase('render'):
+        return render(request, 'index.html', context)
+
+
+def stream_page(request, form, args, context, page):
+    '''
+    Generate the streamed home page.  page, the rendered index.html
+    without its results, goes out before the search runs; then come the
+    results, STREAM_ROWS rows at a time, and the rest of the page.
+
+    The search runs after home has returned, so it is timed, and logged
+    when slow, here rather than in the Server-Timing header.
+    '''
+    (head, tail) = page.split(RESULTS_MARKER)
+    yield head
+    with timing.record() as timings:
+        (res, context['err']) = search_result(request, form, args)
+        context.update(result_context(request, res))
+    timings.log_if_slow(settings.SLOW_SEARCH_MS, path=request.path,
+                        query=request.GET.urlencode())
+    (before, _, after) = render_to_string(
+        'results.html', context, request).partition(ROWS_MARKER)
+    yield before
+    rows = context['result'] or []
+    for start in range(0, len(rows), STREAM_ROWS):
+        yield render_to_string(
+            'rows.html', {'rows': rows[start:start + STREAM_ROWS],
+                          'detail_column': context.get('detail_column')})
+    yield after
+    yield tail
+
+
+# Threads running searches for search_api_async; more would only wait for
+# a pooled connection
+EXECUTOR = ThreadPoolExecutor(max_workers=POOL_SIZE,
+                              thread_name_prefix='search')
+
+
+def json_result(request):
+    '''
+    Validate the search criteria of a request and run the search.
+
+    Outputs:
+    the JSON payload and the HTTP status.  The results are column
+    oriented: data holds one list of values per column of columns.
+    '''
+    form = request_form(request)
+    if not form.is_valid():
+        return ({'errors': form.errors.get_json_data()}, 400)
+    try:
+        with timing.phase('search'):
+            res = run_search(request, form, form_args(form))
+    except ValueError as e:
+        return (json_error(str(e)), 400)
+    return (result_payload(res), 200)
+
+
+def result_payload(res):
+    '''
+    Returns the column oriented JSON payload of a search result.
+    '''
+    (columns, rows) = res
+    if not rows:
+        data = [[] for _ in columns]
+    elif isinstance(rows, Page):
+        data = [rows.column(i) for i in range(rows.width)]
+    else:
+        data = [list(column) for column in zip(*rows)]
+    return {'columns': columns,
+            'data': data,
+            'total': getattr(rows, 'total', len(rows)),
+            'next_cursor': getattr(rows, 'next_cursor', None),
+            'facets': getattr(rows, 'facets', None)}
+
+
+def json_error(message):
+    return {'errors': {'__all__': [{'message': message, 'code': 'invalid'}]}}
+
+
+def json_response(payload, status):
+    return JsonResponse(payload, status=status,
+                        json_dumps_params={'separators': (',', ':')})
+
+
+@timed
+@conditional
+def search_api(request):
+    '''
+    The search as JSON.  Takes the same GET parameters as home, and cursor
+    for the following pages.
+    '''
+    (payload, status) = json_result(request)
+    with timing.phase('serialize'):
+        return json_response(payload, status)
+
+
+async def search_api_async(request):
+    '''
+    search_api as a coroutine, for ASGI servers (see ui/asgi.py): the
+    search runs in EXECUTOR, so that a worker process keeps serving other
+    requests while SQLite is busy.
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(EXECUTOR, partial(search_api, request))
+
+
+@csrf_exempt
+@require_POST
+@timed
+def search_batch_api(request):
+    '''
+    Several searches in one request.  The body is a JSON list of objects
+    holding the GET parameters of search_api, with lists for stores and
+    labels.  Returns the list of their results as search_api does, or of
+    their errors; the searches with the same options run as one batch
+    (see search_items.search_batch).
+    '''
+    try:
+        queries = json.loads(request.body)
+    except ValueError as e:
+        return json_response(json_error(str(e)), 400)
+    if not isinstance(queries, list) or \
+            not all(isinstance(query, dict) for query in queries):
+        return json_response(json_error('expected a list of objects'), 400)
+    if len(queries) > MAX_BATCH:
+        return json_response(json_error(
+            'at most {} searches per batch'.format(MAX_BATCH)), 400)
+
+    results = [None] * len(queries)
+    batches = {}
+    for (i, query) in enumerate(queries):
+        form = SearchForm(query)
+        if not form.is_valid():
+            results[i] = {'errors': form.errors.get_json_data()}
+            continue
+        options = tuple(sorted(form_options(form).items()))
+        batches.setdefault(options, []).append((i, form_args(form)))
+    for (options, batch) in batches.items():
+        for ((i, _), res) in zip(batch, cached_search_batch(
+                [args for (_, args) in batch], **dict(options))):
+            results[i] = result_payload(res)
+    return json_response({'results': results}, 200)
+
+
+def autocomplete_api(request):
+    '''
+    Suggestions completing the last word of the q parameter, as a JSON
+    list; limit sets their number.
+    '''
+    try:
+        limit = int(request.GET.get('limit', autocomplete.DEFAULT_LIMIT))
+    except ValueError:
+        return json_response(json_error('limit must be an integer'), 400)
+    suggestions = autocomplete.get_suggester().suggest(
+        request.GET.get('q', ''), max(limit, 0))
+    return json_response({'suggestions': suggestions}, 200)
+
+
+def product_etag(request, product_id):
+    '''
+    Returns the ETag of a product detail response, from the generation of
+    the database build, or None for a database without a build stamp.
+    '''
+    generation = database_generation()
+    if generation is None:
+        return None
+    return hashlib.sha1(repr((generation[0], request.path))
+                        .encode()).hexdigest()
+
+
+def product_or_404(product_id):
+    details = cached_product_details(product_id)
+    if details is None:
+        raise Http404('No product {}'.format(product_id))
+    return details
+
+
+@timed
+@cache_control(no_cache=True)
+@condition(etag_func=product_etag)
+def product_detail(request, product_id):
+    '''
+    An HTML fragment with the ingredients and nutrition facts of one
+    product, linked from the results of searches on ingredients.
+    '''
+    details = product_or_404(product_id)
+    nutrients = [(label, details[field]) for (field, label) in
+                 DETAIL_NUTRIENTS if details[field] is not None]
+    with timing.phase('render'):
+        return render(request, 'product.html',
+                      {'product': details, 'nutrients': nutrients})
+
+
+@timed
+@cache_control(no_cache=True)
+@condition(etag_func=product_etag)
+def product_api(request, product_id):
+    '''
+    The full record of one product as JSON (see
+    search_items.product_details).
+    '''
+    return json_response(product_or_404(product_id), 200)
@@ -0,0 +1,203 @@
+'''
+Result cache for search_items.search, and for product details.
+
+Results are keyed by a canonical form of the search criteria, so that
+"Greek  Yogurt" and "yogurt greek" share one entry, and evicted in least
+recently used order or once they are older than a time to live.  The
+whole cache is dropped when the database file changes on disk.
+'''
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import search_items
+
+
+# Number of results kept and how long (in seconds) they stay valid
+MAX_ENTRIES = 256
+TTL = 600
+# Number of product details kept
+DETAIL_ENTRIES = 1024
+
+# Fields made of words that are all required (or all excluded)
+WORD_FIELDS = ('product_name', 'contains', 'not_contain')
+
+
+def canonical_args(args_from_ui):
+    '''
+    Returns a hashable canonical form of the search criteria: sorted
+    fields, lowercased and sorted words, sorted label and store lists and
+    float nutrient caps and distance and an int number of nearest stores.
+    '''
+    key = []
+    for field in sorted(args_from_ui):
+        value = args_from_ui[field]
+        if field in WORD_FIELDS:
+            value = tuple(sorted({word.strip(',').lower()
+                                  for word in value.split()}))
+        elif field == 'labels':
+            value = tuple(search_items.requested_labels({'labels': value}))
+        elif field == 'store_name':
+            value = tuple(sorted(set(value)))
+        elif field == 'zipcode':
+            value = str(value).strip()
+        elif field in dict(search_items.NUTRIENT_FILTERS) or \
+                field == 'distance':
+            value = float(value)
+        elif field == 'nearest':
+            value = int(value)
+        else:
+            value = repr(value)
+        key.append((field, value))
+    return tuple(key)
+
+
+def database_version(filename):
+    '''
+    Returns what identifies one build of the database file, or None if
+    it does not exist.
+    '''
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class SearchCache:
+    '''
+    A thread-safe LRU cache with a time to live, tied to one database file.
+    '''
+
+    def __init__(self, filename, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = database_version(filename)
+
+    def get(self, key):
+        '''
+        Returns the cached value for key, or None on a miss.
+        '''
+        self._check_version()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''
+        Returns a dictionary with the hit and miss counters and the
+        number of cached results.
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries)}
+
+    def _check_version(self):
+        '''
+        Drop every entry, and the connections and arrays opened on the old
+        file, when the database has been rebuilt.
+        '''
+        version = database_version(self.filename)
+        if version == self._version:
+            return
+        with self._lock:
+            if version == self._version:
+                return
+            self._version = version
+            self._entries.clear()
+        search_items.reload()
+
+
+CACHE = SearchCache(search_items.DATABASE_FILENAME)
+# Product details, apart so that they do not evict search results
+DETAILS = SearchCache(search_items.DATABASE_FILENAME,
+                      max_entries=DETAIL_ENTRIES)
+
+
+def database_generation():
+    '''
+    Returns the (generation, built_at) stamp of the database file as it
+    is on disk now (see search_items.build_generation), after dropping
+    the cache if the file has been replaced.
+    '''
+    CACHE._check_version()
+    return search_items.build_generation()
+
+
+def cache_key(args_from_ui, kwargs):
+    '''
+    Returns the cache key of a search.  Every engine returns the same
+    results, so it is not part of the key, and no cursor is the same as
+    the first page.
+    '''
+    return (canonical_args(args_from_ui),
+            tuple(sorted((name, value) for (name, value) in kwargs.items()
+                         if name != 'engine' and
+                         not (name == 'cursor' and value is None))))
+
+
+def cached_search(args_from_ui, **kwargs):
+    '''
+    search_items.search through CACHE.  Takes the same arguments.
+    '''
+    key = cache_key(args_from_ui, kwargs)
+    res = CACHE.get(key)
+    if res is None:
+        res = search_items.search(args_from_ui, **kwargs)
+        CACHE.put(key, res)
+    return res
+
+
+def cached_search_batch(args_list, **kwargs):
+    '''
+    search_items.search_batch through CACHE, sharing its entries with
+    cached_search: only the searches missing from the cache run, in one
+    batch.
+    '''
+    keys = [cache_key(args_from_ui, kwargs) for args_from_ui in args_list]
+    results = [CACHE.get(key) for key in keys]
+    missing = [i for (i, res) in enumerate(results) if res is None]
+    if missing:
+        for (i, res) in zip(missing, search_items.search_batch(
+                [args_list[i] for i in missing], **kwargs)):
+            CACHE.put(keys[i], res)
+            results[i] = res
+    return results
+
+
+def cached_product_details(product_id):
+    '''
+    search_items.product_details through DETAILS.
+    '''
+    details = DETAILS.get(product_id)
+    if details is None:
+        details = search_items.product_details(product_id)
+        if details is not None:
+            DETAILS.put(product_id, details)
+    return details
@@ -0,0 +1,387 @@
+'''
+Builds the derived search structures of the foodsearch database.
+
+Run it once after the tables have been loaded with database.sql:
+
+    python search_index.py [path/to/foodsearch.sqlite3]
+
+Every structure is dropped and rebuilt, so running it twice is harmless.
+'''
+
+import ast
+import csv
+import math
+import os
+import re
+import sqlite3
+import sys
+import time
+import uuid
+
+
+# Full-text index over product names and ingredients.  It is an external
+# content table, so the text itself stays in product and the triggers keep
+# the index in sync with later changes to that table.
+FTS_SCHEMA = '''
+DROP TABLE IF EXISTS product_fts;
+CREATE VIRTUAL TABLE product_fts USING fts5(
+    name, ingred,
+    content='product', content_rowid='id',
+    tokenize="unicode61 remove_diacritics 2"
+);
+
+DROP TRIGGER IF EXISTS product_fts_insert;
+CREATE TRIGGER product_fts_insert AFTER INSERT ON product BEGIN
+    INSERT INTO product_fts(rowid, name, ingred)
+    VALUES (new.id, new.name, new.ingred);
+END;
+
+DROP TRIGGER IF EXISTS product_fts_delete;
+CREATE TRIGGER product_fts_delete AFTER DELETE ON product BEGIN
+    INSERT INTO product_fts(product_fts, rowid, name, ingred)
+    VALUES ('delete', old.id, old.name, old.ingred);
+END;
+
+DROP TRIGGER IF EXISTS product_fts_update;
+CREATE TRIGGER product_fts_update AFTER UPDATE OF name, ingred ON product
+BEGIN
+    INSERT INTO product_fts(product_fts, rowid, name, ingred)
+    VALUES ('delete', old.id, old.name, old.ingred);
+    INSERT INTO product_fts(rowid, name, ingred)
+    VALUES (new.id, new.name, new.ingred);
+END;
+
+INSERT INTO product_fts(product_fts) VALUES ('rebuild');
+INSERT INTO product_fts(product_fts) VALUES ('optimize');
+'''
+
+
+# Inverted index from normalized ingredient words to the products whose
+# ingredient list contains them
+INGREDIENT_SCHEMA = '''
+DROP TABLE IF EXISTS ingredient_token;
+CREATE TABLE ingredient_token(
+    token TEXT NOT NULL,
+    product_id INTEGER NOT NULL,
+    PRIMARY KEY(token, product_id)
+) WITHOUT ROWID;
+'''
+
+# Words of product names with the products using them, and the character
+# trigrams of each word, for typo-tolerant name search
+NAME_SCHEMA = '''
+DROP TABLE IF EXISTS name_token;
+DROP TABLE IF EXISTS name_trigram;
+CREATE TABLE name_token(
+    token TEXT NOT NULL,
+    product_id INTEGER NOT NULL,
+    PRIMARY KEY(token, product_id)
+) WITHOUT ROWID;
+CREATE TABLE name_trigram(
+    trigram TEXT NOT NULL,
+    token TEXT NOT NULL,
+    PRIMARY KEY(trigram, token)
+) WITHOUT ROWID;
+'''
+
+# Canonical dietary labels.  Each label also owns one bit of
+# product.label_mask, so filtering on several labels is a single AND.
+LABEL_SCHEMA = '''
+DROP TABLE IF EXISTS product_label;
+DROP TABLE IF EXISTS label;
+CREATE TABLE label(
+    id INTEGER PRIMARY KEY NOT NULL,
+    name TEXT NOT NULL UNIQUE,
+    bit INTEGER NOT NULL UNIQUE
+);
+CREATE TABLE product_label(
+    label_id INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    PRIMARY KEY(label_id, product_id),
+    FOREIGN KEY(label_id) REFERENCES label(id)
+) WITHOUT ROWID;
+'''
+# Bits available in a signed 64-bit SQLite integer
+MAX_LABELS = 63
+
+WORD_RE = re.compile(r'[a-z0-9]+')
+
+# Offline zipcode centroids (Illinois), and the grid of store locations
+# built from them.  A store is placed at the centroid of its zipcode.
+ZIPCODE_FILENAME = os.path.join(os.path.dirname(__file__), '..', 'BackEnd',
+                                'Data', 'zipcode_centroids.csv')
+GEO_SCHEMA = '''
+DROP TABLE IF EXISTS zipcode;
+DROP TABLE IF EXISTS store_location;
+CREATE TABLE zipcode(
+    zipcode TEXT PRIMARY KEY NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE store_location(
+    store_id INTEGER PRIMARY KEY NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    cell_lat INTEGER NOT NULL,
+    cell_lon INTEGER NOT NULL,
+    FOREIGN KEY(store_id) REFERENCES store(id)
+);
+CREATE INDEX store_location_cell ON store_location(cell_lat, cell_lon);
+'''
+# Side of a grid cell, in degrees (about 3.5 miles north to south)
+CELL_DEGREES = 0.05
+
+# Stamp of the last build: a new generation id, and the build time in
+# seconds since the epoch, every time the structures are rebuilt
+BUILD_SCHEMA = '''
+DROP TABLE IF EXISTS build_info;
+CREATE TABLE build_info(
+    generation TEXT NOT NULL,
+    built_at REAL NOT NULL
+);
+'''
+
+
+def normalize_token(word):
+    '''
+    Fold a lowercase word to its singular form, so that "oats", "berries"
+    and "tomatoes" index the same as "oat", "berry" and "tomato".
+    '''
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 4 and word.endswith(('oes', 'ches', 'shes', 'xes')):
+        return word[:-2]
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+
+def ingredient_tokens(text):
+    '''
+    Split ingredient text into the set of normalized tokens used by
+    ingredient_token.
+
+    Inputs:
+    text: a string
+
+    Outputs:
+    a set of strings
+    '''
+    return {normalize_token(word) for word in WORD_RE.findall(text.lower())}
+
+
+def query_tokens(text):
+    '''
+    Returns the set of tokens the words typed by the user may be indexed
+    under: those of each word, of its plural and, for a plural, of the
+    word without its final "s".  Singulars of "-ies" plurals end in "y"
+    in the index, so "cookie" must also look up "cooky", the token of
+    "cookies", and "cookies" must also look up "cookie".
+    '''
+    tokens = set()
+    for word in WORD_RE.findall(text.lower()):
+        forms = [word, word + 's']
+        if len(word) > 3 and word.endswith('s'):
+            forms.append(word[:-1])
+        tokens.update(normalize_token(form) for form in forms)
+    return tokens
+
+
+def trigrams(word):
+    '''
+    Returns the set of character trigrams of a word, padded with a space
+    on both sides so that its first and last letters weigh more.
+    '''
+    padded = ' {} '.format(word)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def canonical_label(label):
+    '''
+    Map a label as scraped or typed ("Gluten_Free", "low sodium**",
+    "kosher+") to its canonical name ("gluten free", "low sodium",
+    "kosher").
+    '''
+    label = label.lower().replace('_', ' ').strip(' *+')
+    return ' '.join(label.split())
+
+
+def parse_labels(labels):
+    '''
+    Parse the labels column, a stringified Python set or list such as
+    "{'vegan', 'dairy free'}", into a set of canonical labels.
+    '''
+    if not labels:
+        return set()
+    return {canonical_label(label) for label in ast.literal_eval(labels)}
+
+
+def grid_cell(latitude, longitude):
+    '''
+    Returns the (row, column) of the grid cell containing a point.
+    '''
+    return (math.floor(latitude / CELL_DEGREES),
+            math.floor(longitude / CELL_DEGREES))
+
+
+def fts_phrase(word):
+    '''
+    Quote a word typed by the user as an FTS5 prefix phrase, so that it
+    matches every token starting with it.  Returns None for words without
+    any letter or digit, which the tokenizer would reduce to nothing.
+
+    Inputs:
+    word: a string
+
+    Outputs:
+    a string that can be used on the right of a column filter, or None
+    '''
+    if not any(ch.isalnum() for ch in word):
+        return None
+    return '"{}"*'.format(word.replace('"', '""'))
+
+
+def build_fts(conn):
+    '''
+    Create and fill product_fts.  Returns False, leaving the database
+    unchanged, when the SQLite library was compiled without FTS5.
+    '''
+    try:
+        conn.executescript(FTS_SCHEMA)
+    except sqlite3.OperationalError as e:
+        if 'fts5' not in str(e):
+            raise
+        print('FTS5 is not available, skipping product_fts')
+        return False
+    return True
+
+
+def build_ingredient_index(conn):
+    '''
+    Create and fill ingredient_token with one row per distinct token of
+    each product's ingredients.
+    '''
+    conn.executescript(INGREDIENT_SCHEMA)
+    rows = conn.execute(
+        "SELECT id, ingred FROM product WHERE ingred IS NOT NULL")
+    conn.executemany(
+        "INSERT INTO ingredient_token(token, product_id) VALUES (?, ?)",
+        ((token, product_id) for (product_id, ingred) in rows.fetchall()
+         for token in ingredient_tokens(ingred)))
+
+
+def build_name_index(conn):
+    '''
+    Create and fill name_token with the lowercased words of each product
+    name, and name_trigram with the trigrams of every word.
+    '''
+    conn.executescript(NAME_SCHEMA)
+    products = {}
+    for (product_id, name) in conn.execute(
+            "SELECT id, name FROM product WHERE name IS NOT NULL").fetchall():
+        for token in set(WORD_RE.findall(name.lower())):
+            products.setdefault(token, []).append(product_id)
+    conn.executemany(
+        "INSERT INTO name_token(token, product_id) VALUES (?, ?)",
+        ((token, product_id) for (token, product_ids) in products.items()
+         for product_id in product_ids))
+    conn.executemany(
+        "INSERT INTO name_trigram(trigram, token) VALUES (?, ?)",
+        ((trigram, token) for token in products
+         for trigram in trigrams(token)))
+
+
+def build_label_index(conn):
+    '''
+    Parse product.labels into the label vocabulary, the product_label join
+    table and the product.label_mask bitmask column.
+    '''
+    conn.executescript(LABEL_SCHEMA)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(product)")]
+    if 'label_mask' not in columns:
+        conn.execute("ALTER TABLE product "
+                     "ADD COLUMN label_mask INTEGER NOT NULL DEFAULT 0")
+
+    product_labels = {
+        product_id: parse_labels(labels) for (product_id, labels) in
+        conn.execute("SELECT id, labels FROM product").fetchall()}
+    counts = {}
+    for labels in product_labels.values():
+        for label in labels:
+            counts[label] = counts.get(label, 0) + 1
+    if len(counts) > MAX_LABELS:
+        raise ValueError('label_mask holds at most {} labels, found {}'
+                         .format(MAX_LABELS, len(counts)))
+
+    # Most common labels first, so ids stay stable as rare labels are added
+    vocabulary = sorted(counts, key=lambda label: (-counts[label], label))
+    label_id = {label: i for (i, label) in enumerate(vocabulary)}
+    conn.executemany("INSERT INTO label(id, name, bit) VALUES (?, ?, ?)",
+                     ((i, label, i) for (label, i) in label_id.items()))
+    conn.executemany(
+        "INSERT INTO product_label(label_id, product_id) VALUES (?, ?)",
+        ((label_id[label], product_id)
+         for (product_id, labels) in product_labels.items()
+         for label in labels))
+    conn.executemany(
+        "UPDATE product SET label_mask = ? WHERE id = ?",
+        ((sum(1 << label_id[label] for label in labels), product_id)
+         for (product_id, labels) in product_labels.items()))
+
+
+def build_geo_index(conn, zipcode_filename=ZIPCODE_FILENAME):
+    '''
+    Load the zipcode centroids and place every store with a known zipcode
+    on the grid of store_location.
+    '''
+    conn.executescript(GEO_SCHEMA)
+    with open(zipcode_filename, newline='') as f:
+        conn.executemany(
+            "INSERT INTO zipcode(zipcode, latitude, longitude) "
+            "VALUES (?, ?, ?)",
+            ((row['zipcode'], float(row['latitude']), float(row['longitude']))
+             for row in csv.DictReader(f)))
+    located = conn.execute(
+        "SELECT store.id, zipcode.latitude, zipcode.longitude FROM store "
+        "JOIN zipcode ON zipcode.zipcode = CAST(store.zipcode AS TEXT)")
+    conn.executemany(
+        "INSERT INTO store_location VALUES (?, ?, ?, ?, ?)",
+        ((store_id, latitude, longitude) + grid_cell(latitude, longitude)
+         for (store_id, latitude, longitude) in located.fetchall()))
+
+
+def stamp_build(conn):
+    '''
+    Record a new generation id for the database, which identifies its
+    contents in the ETags of search responses.
+    '''
+    conn.executescript(BUILD_SCHEMA)
+    conn.execute("INSERT INTO build_info VALUES (?, ?)",
+                 (uuid.uuid4().hex, time.time()))
+
+
+# Every structure, in build order; stamp_build comes last
+BUILD_STEPS = [build_fts, build_ingredient_index, build_name_index,
+               build_label_index, build_geo_index, stamp_build]
+
+
+def build(filename=None):
+    '''
+    Build every derived structure in the given database file, which
+    defaults to the one used by search_items.
+    '''
+    if filename is None:
+        from search_items import DATABASE_FILENAME
+        filename = DATABASE_FILENAME
+    conn = sqlite3.connect(filename)
+    try:
+        for step in BUILD_STEPS:
+            step(conn)
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    build(*sys.argv[1:2])
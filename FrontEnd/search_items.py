@@ -1,71 +1,1001 @@
-import sqlite3
+import atexit
+import base64
+import heapq
+import json
 import os
+import queue
+import sqlite3
+import sys
+import threading
+from array import array
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
+from urllib.request import pathname2url
+
+import jellyfish
+
+import ranking
+import store_locator
+import timing
+from search_index import (WORD_RE, canonical_label, fts_phrase,
+                          parse_labels, query_tokens, trigrams)
 
 
 # Use this filename for the database
 DATA_DIR = os.path.dirname(__file__)
 DATABASE_FILENAME = os.path.join(DATA_DIR, 'foodsearch.sqlite3')
 
+# Maximum number of connections open at the same time
+POOL_SIZE = 8
+# Pragmas applied once to every pooled connection; the web tier only reads
+READ_PRAGMAS = (
+    "PRAGMA query_only = ON",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+)
+# In the memory-mapped serving mode, the first MMAP_SIZE bytes of the file
+# are mapped and every connection keeps a larger page cache
+MMAP_SIZE = 256 * 1024 * 1024
+MAPPED_PRAGMAS = (
+    "PRAGMA mmap_size = {}".format(MMAP_SIZE),
+    "PRAGMA cache_size = -32000",
+)
+# Size of the reads of warm_up, in bytes
+WARM_CHUNK = 1024 * 1024
+
+
+# Values of a result column looked at to decide whether its strings repeat
+# enough to be interned (see ColumnBuilder)
+INTERN_SAMPLE = 100
+# Rows added at a time to the columns of a Page
+PAGE_CHUNK = 1024
+NAN = float('nan')
+
+# Renamed jaro_winkler_similarity in jellyfish 0.8
+jaro_winkler = getattr(jellyfish, 'jaro_winkler_similarity', None) or \
+    jellyfish.jaro_winkler
+
+
+class ConnectionPool:
+    '''
+    A bounded pool of read-only connections to the search database.
+
+    Connections are opened lazily, at most `size` of them, and handed
+    back to the pool after each query instead of being closed, so a
+    search only pays for connecting and parsing the schema once per
+    pooled connection.
+
+    When mapped is set, the file is opened as immutable and read through
+    a memory map (see set_mapped).
+    '''
+
+    def __init__(self, filename, size=POOL_SIZE):
+        self.filename = filename
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = []
+        # Names of the usable tables and the (generation, built_at) stamp of
+        # the build (see search_index.stamp_build), found when the first
+        # connection opens
+        self.tables = None
+        self.generation = None
+        self.mapped = False
+
+    def _open(self):
+        uri = 'file:{}?mode=ro'.format(pathname2url(self.filename))
+        pragmas = READ_PRAGMAS
+        if self.mapped:
+            uri += '&immutable=1'
+            pragmas += MAPPED_PRAGMAS
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        for pragma in pragmas:
+            conn.execute(pragma)
+        conn.create_function('jaro_winkler', 2, jaro_winkler,
+                             deterministic=True)
+        if self.tables is None:
+            tables = _usable_tables(conn)
+            self.generation = _build_generation(conn, tables)
+            self.tables = tables
+        with self._lock:
+            self._opened.append(conn)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        '''
+        Borrow a connection for the duration of a with block, blocking
+        while all `size` connections are in use.
+        '''
+        with self._slots:
+            with self._lock:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    conn = None
+            if conn is None:
+                conn = self._open()
+            try:
+                yield conn
+            finally:
+                with self._lock:
+                    stale = conn not in self._opened
+                    if not stale:
+                        self._idle.put(conn)
+                # Connections borrowed during close() are closed on return
+                if stale:
+                    conn.close()
+
+    def set_mapped(self, mapped):
+        '''
+        Switch the memory-mapped serving mode on or off, closing the open
+        connections.  SQLite then skips locking and change detection on
+        the immutable file, so a rebuilt database must replace the file
+        (e.g. be renamed over it) rather than be written in place.
+        '''
+        self.mapped = mapped
+        self.close()
+
+    def close(self):
+        '''
+        Close the idle connections of the pool and forget the others, which
+        are closed when their borrowers hand them back.  The pool stays
+        usable and reopens connections on demand.
+        '''
+        with self._lock:
+            self._opened = []
+            idle, self._idle = self._idle, queue.LifoQueue()
+            self.tables = None
+            self.generation = None
+        while True:
+            try:
+                idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def _usable_tables(conn):
+    '''
+    Returns the set of table names in the database.  product_fts is left
+    out when this SQLite library cannot read it (compiled without FTS5).
+    '''
+    tables = {name for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if 'product_fts' in tables:
+        try:
+            conn.execute("SELECT rowid FROM product_fts LIMIT 0")
+        except sqlite3.OperationalError:
+            tables.discard('product_fts')
+    return tables
+
+
+def _build_generation(conn, tables):
+    '''
+    Returns the (generation, built_at) stamp of the database, or None if
+    it was built before builds were stamped.
+    '''
+    if 'build_info' not in tables:
+        return None
+    return conn.execute(
+        "SELECT generation, built_at FROM build_info").fetchone()
+
+
+def build_generation():
+    '''
+    Returns the (generation, built_at) stamp of the database build.  It
+    is kept by POOL, so only the first call after a reload opens the
+    database.
+    '''
+    if POOL.tables is None:
+        with POOL.connection():
+            pass
+    return POOL.generation
+
+
+POOL = ConnectionPool(DATABASE_FILENAME)
+atexit.register(POOL.close)
+
+def reload():
+    '''
+    Close the pooled connections and drop the stores, arrays and words
+    loaded in memory, so that the next search reads the database file as it is now.
+    '''
+    global _STORES
+    POOL.close()
+    with _STORES_LOCK:
+        _STORES = None
+    store_locator.clear()
+    for name in ('numpy_engine', 'autocomplete'):
+        module = sys.modules.get(name)
+        if module is not None:
+            module.clear()
+
+
+def warm_up(engine='sql'):
+    '''
+    Prepare for the first searches after a start: read the file, up to
+    MMAP_SIZE bytes, so that its pages are in the operating system's
+    cache that the memory map reads from, and load the stores, the store
+    grid and, for the numpy engine, the product arrays.
+
+    Outputs:
+    the number of bytes read
+    '''
+    buffer = bytearray(WARM_CHUNK)
+    size = 0
+    with open(POOL.filename, 'rb') as f:
+        while size < MMAP_SIZE:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            size += n
+    with POOL.connection() as conn:
+        chain_stores(conn)
+        if 'store_location' in POOL.tables:
+            store_locator.get_grid(conn)
+        if engine == 'numpy':
+            import numpy_engine
+            numpy_engine.get_arrays(conn, POOL.tables)
+    return size
+
+
+# Nutrient fields of the search criteria and how the product column is
+# compared to them, in the order they are shown
+NUTRIENT_FILTERS = [
+    ('calories', '<='),
+    ('trans_fat', '<='),
+    ('tot_fat', '<='),
+    ('sodium', '<='),
+    ('tot_carhy', '<='),
+    ('protein', '>='),
+    ('sugars', '<='),
+]
+
+# Columns of the product table returned by product_details
+DETAIL_FIELDS = ['id', 'name', 'store', 'labels', 'serv_size', 'tot_ser',
+                 'calories', 'tot_fat', 'satu_fat', 'trans_fat',
+                 'cholesterol', 'sodium', 'tot_carhy', 'diet_fiber',
+                 'sugars', 'protein', 'ingred']
+
+# Query engines that search() can run on
+ENGINES = ('sql', 'numpy')
+
+# With args_from_ui['fuzzy'], a word of the product name also matches the
+# MAX_SIMILAR words of product names closest to it, if their Jaro-Winkler
+# similarity is at least MIN_SIMILARITY
+MIN_SIMILARITY = 0.85
+MAX_SIMILAR = 5
+
+
+class Page:
+    '''
+    One page of result rows.  Besides the rows, it carries next_cursor,
+    the cursor of the following page (None on the last page), and total,
+    the number of rows matching the search across all pages.  facets
+    holds the facet counts when they were asked for (see tally_facets).
+
+    The rows are kept by column (see ColumnBuilder): nutrients,
+    distances and scores in typed arrays, and repeated strings such as
+    store names and addresses interned once.  Rows of different lengths
+    are refused when the page is built, so a page is always a valid
+    table of width columns.  It iterates, indexes and compares as the
+    list of its row tuples.
+    '''
+
+    def __init__(self, rows, next_cursor, total, facets=None, key_size=0):
+        '''
+        rows may be any iterable of row tuples, such as the rows of a
+        query from timing.fetch_rows: they are read PAGE_CHUNK at a time
+        into the columns, so they never all exist as tuples at once.
+        key_size trailing columns of the rows, the ids they were ordered
+        by, are kept apart (see key).  total defaults to the number of
+        rows.
+        '''
+        rows = iter(rows)
+        builders = None
+        length = 0
+        while True:
+            chunk = list(islice(rows, PAGE_CHUNK))
+            if not chunk:
+                break
+            widths = set(map(len, chunk))
+            if builders is not None:
+                widths.add(len(builders))
+            if len(widths) > 1:
+                raise ValueError('result rows of different lengths')
+            if builders is None:
+                builders = [ColumnBuilder() for _ in range(widths.pop())]
+            for (i, builder) in enumerate(builders):
+                builder.extend(list(map(itemgetter(i), chunk)))
+            length += len(chunk)
+        if builders is None:
+            builders = [ColumnBuilder() for _ in range(key_size)]
+        self.width = len(builders) - key_size
+        self.columns = [builder.values for builder in builders[:self.width]]
+        # Positions of the NULLs, stored as NaN, of the columns of doubles
+        self._nulls = {i: builder.nulls
+                       for (i, builder) in enumerate(builders[:self.width])
+                       if builder.nulls}
+        self._keys = [builder.values for builder in builders[self.width:]]
+        self._length = length
+        self.next_cursor = next_cursor
+        self.total = length if total is None else total
+        self.facets = facets
+
+    def column(self, i):
+        '''
+        Returns column i as a list, with NULLs as None.
+        '''
+        values = self._values(i)
+        return values.copy() if values is self.columns[i] else values
 
-def search(args_from_ui):
+    def _values(self, i):
+        column = self.columns[i]
+        if isinstance(column, list):
+            return column
+        values = column.tolist()
+        for j in self._nulls.get(i, ()):
+            values[j] = None
+        return values
+
+    def key(self, index):
+        '''
+        Returns the ids that row index was ordered by.
+        '''
+        return tuple(column[index] for column in self._keys)
+
+    def truncate(self, length):
+        '''
+        Keep only the first length rows.
+        '''
+        for column in self.columns + self._keys:
+            del column[length:]
+        for (i, nulls) in list(self._nulls.items()):
+            nulls = [j for j in nulls if j < length]
+            if nulls:
+                self._nulls[i] = nulls
+            else:
+                del self._nulls[i]
+        self._length = min(self._length, length)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return zip(*[self._values(i) for i in range(self.width)])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            columns = []
+            for (i, column) in enumerate(self.columns):
+                values = column[index]
+                if not isinstance(values, list):
+                    values = values.tolist()
+                if i in self._nulls:
+                    # NaN, the only value unequal to itself, stands for NULL
+                    values = [None if value != value else value
+                              for value in values]
+                columns.append(values)
+            return list(zip(*columns))
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('page index out of range')
+        row = [column[index] for column in self.columns]
+        for i in self._nulls:
+            if row[i] != row[i]:
+                row[i] = None
+        return tuple(row)
+
+    def __eq__(self, other):
+        if isinstance(other, (Page, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return 'Page({!r}, {!r}, {!r})'.format(list(self), self.next_cursor,
+                                               self.total)
+
+
+class ColumnBuilder:
+    '''
+    Builds one compact column of a Page from chunks of its values: an
+    array of doubles for floats, with NULLs stored as NaN and their
+    positions kept in nulls, an array of 64-bit integers for integers,
+    and a list otherwise, whose strings are interned when they repeat (at
+    most one distinct string in two among the first INTERN_SAMPLE
+    values).  The kind is chosen on the first chunk, and a later chunk
+    that does not fit it turns the column into a list; integers in a
+    column of doubles become floats, as in a REAL column of SQLite.
+    '''
+
+    def __init__(self):
+        self.values = None
+        self.nulls = []
+        self.intern = False
+
+    def extend(self, values):
+        '''
+        Append a list of values.
+        '''
+        column = self.values
+        if column is None:
+            self._start(values)
+            column = self.values
+        if isinstance(column, array):
+            # fromlist leaves the array unchanged when a value does not fit
+            try:
+                column.fromlist(values)
+                return
+            except (TypeError, OverflowError):
+                pass
+            kinds = set(map(type, values)) - {type(None)}
+            if column.typecode == 'd' and \
+                    all(issubclass(kind, float) for kind in kinds):
+                start = len(column)
+                self.nulls += [start + j for (j, value) in enumerate(values)
+                               if value is None]
+                column.fromlist([NAN if value is None else value
+                                 for value in values])
+                return
+            self._to_list()
+            column = self.values
+        if self.intern:
+            kinds = set(map(type, values))
+            if _all_kinds(kinds, str):
+                if kinds != {str}:
+                    values = map(str, values)
+                values = map(sys.intern, values)
+            else:
+                self.intern = False
+        column.extend(values)
+
+    def _start(self, values):
+        kinds = set(map(type, values))
+        if _all_kinds(kinds - {type(None)}, float):
+            self.values = array('d')
+        elif kinds == {int}:
+            self.values = array('q')
+        else:
+            self.values = []
+            sample = values[:INTERN_SAMPLE]
+            self.intern = _all_kinds(kinds, str) and \
+                len(set(sample)) * 2 <= len(sample)
+
+    def _to_list(self):
+        values = self.values.tolist()
+        for j in self.nulls:
+            values[j] = None
+        self.values = values
+        self.nulls = []
+        self.intern = False
+
+
+def _all_kinds(kinds, kind):
+    '''
+    Whether a set of value types is not empty and only holds subclasses
+    of kind.
+    '''
+    return bool(kinds) and all(issubclass(other, kind) for other in kinds)
+
+
+def search(args_from_ui, engine='sql', page_size=None, cursor=None,
+           group_stores=False, top_k=None, profile=ranking.DEFAULT_PROFILE,
+           facets=False):
     '''
     Takes a dictionary containing search criteria and returns products
     that match the criteria.
 
-    Returns a pair: an ordered list of attribute names and a list the
+    Returns a pair: an ordered list of attribute names and a Page
      containing query results.  Returns ([], []) when the dictionary
      is empty.
+
+    engine selects how the query runs: 'sql' builds one SQLite query,
+    'numpy' evaluates the nutrient, label and store filters on in-memory
+    arrays (see numpy_engine.py).  Both return the same results.
+
+    With a page_size, the results are ordered by product and store and
+    only the page_size rows following cursor (None for the first page)
+    are returned.  Pages are found by key rather than by
+    offset, so every page costs about the same.
+
+    By default a product is repeated for every store of its chain.  With
+    group_stores, each product appears once and the store columns list
+    the matching stores, separated by "; ".
+
+    When the zipcode is in the zipcode table, only the stores within
+    args_from_ui['distance'] miles of it, or its args_from_ui['nearest']
+    closest stores, are kept (see store_locator.py), a distance column is
+    added and each product's stores come closest first.  Otherwise stores
+    match on the zipcode's first four digits.
+
+    With top_k, only the top_k products that best fit the nutrient
+    criteria under the scoring profile (see ranking.py) are returned,
+    best first, with a score column.  A page then holds all of them.
+
+    With facets, the facets attribute of the Page counts the matching
+    rows per store chain and per dietary label, across all pages and
+    before top_k (see tally_facets).  They come from one aggregate query
+    over the products, which also gives the total, or from the pass that
+    scores products.
     '''
     assert isinstance(args_from_ui, dict)
-    conn = sqlite3.connect("foodsearch.sqlite3")
-    c = conn.cursor()
+    if engine not in ENGINES:
+        raise ValueError('unknown search engine: {}'.format(engine))
+    # If no argument passed in, return empty lists
+    if not args_from_ui:
+        return ([], [])
 
+    with POOL.connection() as conn:
+        with timing.phase('nearby'):
+            nearby = store_locator.find_nearby(conn, args_from_ui,
+                                               POOL.tables)
+        if engine == 'numpy':
+            import numpy_engine
+            with timing.phase('numpy'):
+                return numpy_engine.search(args_from_ui, conn, POOL.tables,
+                                           page_size, cursor, group_stores,
+                                           nearby, top_k, profile, facets)
+        if top_k is not None:
+            (header, rows, facet_counts) = search_ranked(
+                conn, args_from_ui, POOL.tables, top_k, profile,
+                group_stores, nearby, facets)
+            return (header, Page(rows, None, len(rows), facet_counts))
+        facet_counts = count_facets(conn, args_from_ui, POOL.tables,
+                                    group_stores, nearby) if facets else None
+        if group_stores:
+            return search_grouped(conn, args_from_ui, POOL.tables,
+                                  page_size, cursor, nearby, facet_counts)
+        with timing.phase('build'):
+            select = make_select(args_from_ui, nearby)
+            from_ = make_from(args_from_ui)
+            query, param = make_condition(args_from_ui, POOL.tables,
+                                          nearby=nearby)
+            # Within a product, stores are ordered by id or by distance
+            store_key = "store.id" if nearby is None else store_rank(nearby)
+        c = conn.cursor()
+        if page_size is not None:
+            return search_page(c, select, from_, query, param,
+                               page_size, cursor, store_key, facet_counts)
+        where = " AND ".join(query) or "1"
+        if nearby is not None:
+            where += " ORDER BY product.id, " + store_key
+        rows = Page(timing.fetch_rows(c, select + from_ + where, param),
+                    None, None, facet_counts)
+        return (get_header(c), rows)
 
-    if args_from_ui:
-        select = make_select(args_from_ui)
-        from_ = make_from(args_from_ui)
-        query, param = make_condition(args_from_ui)
-        c.execute(select + from_ + " AND ".join(query), param)
-        return (get_header(c), c.fetchall())
-    conn.close()
-    # If no argument passed in, return empty lists
-    return ([], [])
 
-def make_select(args_from_ui):
-    base = "SELECT "
+def search_batch(args_list, page_size=None, group_stores=False, top_k=None,
+                 profile=ranking.DEFAULT_PROFILE, facets=False):
+    '''
+    Takes a list of dictionaries of search criteria and returns the list
+    of their results, each as search would return it with the same
+    options (the first page only, with a page_size).
+
+    The searches share one connection and are evaluated together on the
+    in-memory product arrays of numpy_engine, whatever the engine setting:
+    each one is a few vectorized masks over arrays loaded once, instead of
+    a scan of the product table, and identical name, ingredient and label
+    conditions are only queried once.
+    '''
+    import numpy_engine
+    results = [([], [])] * len(args_list)
+    batch = [i for (i, args_from_ui) in enumerate(args_list) if args_from_ui]
+    with POOL.connection() as conn:
+        nearby_list = [store_locator.find_nearby(conn, args_list[i],
+                                                 POOL.tables) for i in batch]
+        batch_results = numpy_engine.search_batch(
+            [args_list[i] for i in batch], conn, POOL.tables, nearby_list,
+            page_size, group_stores, top_k, profile, facets)
+    for (i, res) in zip(batch, batch_results):
+        results[i] = res
+    return results
+
+
+def search_page(c, select, from_, query, param, page_size, cursor,
+                store_key="store.id", facets=None):
+    '''
+    Run the query for one page of results, ordered by product id and then
+    store_key.  The total is counted on the first page only and then
+    carried along in the cursor, unless it can be added up from the facet
+    counts.
+    '''
+    (after, total) = decode_cursor(cursor, key_size=2)
+    where = " AND ".join(query) or "1"
+    if facets is not None:
+        total = sum(facets['store_name'].values())
+    elif total is None:
+        total = timing.fetch_all(c, "SELECT COUNT(*)" + from_ + where,
+                                 param)[0][0]
+    if after is not None:
+        where += " AND (product.id, {}) > (?, ?)".format(store_key)
+        param += after
+    page = make_page(timing.fetch_rows(
+        c, select + ", product.id, " + store_key + from_ + where +
+        " ORDER BY product.id, " + store_key + " LIMIT ?",
+        param + (page_size + 1,)), page_size, total, facets=facets)
+    return (get_header(c)[:-2], page)
+
+
+def search_grouped(conn, args_from_ui, tables, page_size=None, cursor=None,
+                   nearby=None, facets=None):
+    '''
+    Run the search with one row per product.  The query only reads the
+    product table, checking that its chain has a matching store, and the
+    store columns are filled in from chain_stores, so rows are never
+    multiplied by the number of stores.  Pages are keyed by product id.
+    '''
+    columns = select_columns(args_from_ui, nearby)
+    fields = [column for column in columns if column.startswith("product.")]
+    query, param = make_condition(args_from_ui, tables, group_stores=True,
+                                  nearby=nearby)
+    from_ = make_from(args_from_ui, group_stores=True)
+    where = " AND ".join(query) or "1"
+    if page_size is not None:
+        (after, total) = decode_cursor(cursor, key_size=1)
+        if facets is not None:
+            total = sum(facets['store_name'].values())
+        elif total is None:
+            total = timing.fetch_all(conn, "SELECT COUNT(*)" + from_ +
+                                     where, param)[0][0]
+        if after is not None:
+            where += " AND product.id > ?"
+            param += after
+        where += " ORDER BY product.id LIMIT ?"
+        param += (page_size + 1,)
+
+    stores = chain_stores(conn)
+    rows = []
+    for (product_id, chain, *values) in timing.fetch_all(
+            conn, "SELECT product.id, product.store, " + ", ".join(fields) +
+            from_ + where, param):
+        values = dict(zip(fields, values))
+        matching = matching_stores(stores.get(chain, []), args_from_ui,
+                                   nearby)
+        row = tuple(values[column] if column in values else
+                    group_store_column(column, chain, matching)
+                    for column in columns)
+        if page_size is not None:
+            row += (product_id,)
+        rows.append(row)
+
+    header = [column.split(".")[1] for column in columns]
+    if page_size is None:
+        return (header, Page(rows, None, None, facets))
+    return (header, make_page(rows, page_size, total, key_size=1,
+                              facets=facets))
+
+
+def search_ranked(conn, args_from_ui, tables, top_k, profile,
+                  group_stores=False, nearby=None, facets=False):
+    '''
+    Run the search keeping only the top_k best scored products.  Products
+    are read without the store join and stream through a bounded heap,
+    so the cost of ranking grows with the number of candidates, not with
+    a full sort of the results.
+
+    Returns the header, the rows and the facet counts of every candidate
+    (None unless facets is set).
+    '''
+    terms = ranking.scoring_terms(args_from_ui, NUTRIENT_FILTERS, profile)
+    columns = select_columns(args_from_ui, nearby)
+    fields = [column.split(".")[1] for column in columns
+              if column.startswith("product.")]
+    fields += [field for (field, _, _, _) in terms if field not in fields]
+    query, param = make_condition(args_from_ui, tables, group_stores=True,
+                                  nearby=nearby)
+    rows = timing.fetch_all(
+        conn, "SELECT product.id, product.store, product.labels, " +
+        ", ".join("product." + field for field in fields) +
+        make_from(args_from_ui, group_stores=True) +
+        (" AND ".join(query) or "1"), param)
+
+    groups = {}
+    candidates = []
+    for (product_id, chain, labels, *values) in rows:
+        values = dict(zip(fields, values))
+        candidates.append((ranking.score(values, terms), product_id,
+                           chain, values))
+        groups[chain, labels] = groups.get((chain, labels), 0) + 1
+    stores = chain_stores(conn)
+    best = heapq.nlargest(top_k, candidates,
+                          key=lambda candidate: (candidate[0], -candidate[1]))
+    (header, rows) = ranked_rows(best, columns, args_from_ui, stores,
+                                 group_stores, nearby)
+    facet_counts = None
+    if facets:
+        facet_counts = tally_facets(
+            [(chain, labels, count) for ((chain, labels), count) in
+             groups.items()], stores, args_from_ui, group_stores, nearby)
+    return (header, rows, facet_counts)
+
+
+def ranked_rows(best, columns, args_from_ui, stores, group_stores=False,
+                nearby=None):
+    '''
+    Build the header and rows of a ranked search from the best products,
+    (score, product id, chain, values) tuples in rank order, where values
+    maps product fields to their value.  Scores are rounded to 4 digits.
+    '''
+    rows = []
+    for (product_score, _, chain, values) in best:
+        matching = matching_stores(stores.get(chain, []), args_from_ui,
+                                   nearby)
+        score_value = round(product_score, 4)
+        if group_stores:
+            rows.append(tuple(
+                values[column.split(".")[1]] if column.startswith("product.")
+                else group_store_column(column, chain, matching)
+                for column in columns) + (score_value,))
+            continue
+        for store in matching:
+            rows.append(tuple(
+                values[field] if table == "product" else store[field]
+                for (table, field) in
+                (column.split(".") for column in columns)) + (score_value,))
+    return ([column.split(".")[1] for column in columns] + ["score"], rows)
+
+
+def group_store_column(column, chain, stores):
+    '''
+    Returns the value of a store column for a product shown once: the
+    chain name, or the values of the matching stores joined by "; ".
+    '''
+    field = column.split(".")[1]
+    if field == "name":
+        return chain
+    return "; ".join(str(store[field]) for store in stores)
+
+
+def count_facets(conn, args_from_ui, tables, group_stores=False,
+                 nearby=None):
+    '''
+    Count the result rows per store chain and per dietary label.  A single
+    aggregate query counts the matching products per (chain, labels) pair,
+    without joining the stores.
+    '''
+    query, param = make_condition(args_from_ui, tables, group_stores=True,
+                                  nearby=nearby)
+    groups = timing.fetch_all(
+        conn, "SELECT product.store, product.labels, COUNT(*)" +
+        make_from(args_from_ui, group_stores=True) +
+        (" AND ".join(query) or "1") +
+        " GROUP BY product.store, product.labels", param)
+    return tally_facets(groups, chain_stores(conn), args_from_ui,
+                        group_stores, nearby)
+
+
+def tally_facets(groups, stores, args_from_ui, group_stores=False,
+                 nearby=None):
+    '''
+    Add up (chain, labels, number of products) groups, where labels is
+    the raw labels column, into the facet counts.  Without group_stores a
+    product counts once per matching store of its chain, like its rows.
+
+    Outputs:
+    a dictionary with the number of rows per store chain ('store_name')
+    and per canonical dietary label ('labels'), each ordered by
+    decreasing count
+    '''
+    chain_rows = {}
+    for chain in {chain for (chain, _, _) in groups}:
+        matching = matching_stores(stores.get(chain, []), args_from_ui,
+                                   nearby)
+        chain_rows[chain] = min(len(matching), 1) if group_stores \
+            else len(matching)
+    chains = {}
+    label_texts = {}
+    for (chain, label_text, count) in groups:
+        count *= chain_rows[chain]
+        chains[chain] = chains.get(chain, 0) + count
+        label_texts[label_text] = label_texts.get(label_text, 0) + count
+    labels = {}
+    for (label_text, count) in label_texts.items():
+        for label in _label_set(label_text):
+            labels[label] = labels.get(label, 0) + count
+    return facet_dict(chains.items(), labels.items())
+
+
+def facet_dict(chain_counts, label_counts):
+    '''
+    Returns the facet counts from (chain, count) and (label, count) pairs,
+    leaving out zero counts.
+    '''
+    return {field: dict(sorted(((name, int(count)) for (name, count) in
+                                counts if count),
+                               key=lambda item: (-item[1], item[0])))
+            for (field, counts) in (('store_name', chain_counts),
+                                    ('labels', label_counts))}
+
+
+@lru_cache(maxsize=4096)
+def _label_set(label_text):
+    '''
+    parse_labels, remembered across searches since products share a few
+    thousand distinct labels values.
+    '''
+    return frozenset(parse_labels(label_text))
+
+
+def make_page(rows, page_size, total, key_size=2, facets=None):
+    '''
+    Build a Page from up to page_size + 1 rows, each ending with the
+    key_size ids they are ordered by (product and store ids, or only the
+    product id).  The extra row only tells whether there is a next page.
+    '''
+    page = Page(rows, None, total, facets, key_size)
+    if len(page) > page_size:
+        page.truncate(page_size)
+        page.next_cursor = encode_cursor(page.key(page_size - 1), total)
+    return page
+
+
+def encode_cursor(after, total):
+    '''
+    Make the opaque cursor of the page starting after the given key, a
+    tuple of ids.
+    '''
+    data = json.dumps(list(after) + [total]).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def decode_cursor(cursor, key_size):
+    '''
+    Returns the key and the total stored in a cursor, or (None, None) for
+    the first page.  Raises ValueError for a cursor that was not made by
+    encode_cursor, or whose key does not have key_size ids (1 for pages
+    of products, 2 for pages of products and stores).
+    '''
+    if not cursor:
+        return (None, None)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError):
+        raise ValueError('invalid cursor')
+    if not (isinstance(values, list) and len(values) == key_size + 1 and
+            all(isinstance(value, int) for value in values)):
+        raise ValueError('invalid cursor')
+    return (tuple(values[:-1]), values[-1])
+
+
+_STORES = None
+_STORES_LOCK = threading.Lock()
+
+
+def product_details(product_id):
+    '''
+    Returns the full record of one product, with its ingredients and
+    every nutrient, as a dictionary of DETAIL_FIELDS, or None if there is
+    no such product.  The labels are the sorted list of its canonical
+    labels.
+    '''
+    with POOL.connection() as conn:
+        rows = timing.fetch_all(
+            conn, "SELECT {} FROM product WHERE id = ?".format(
+                ", ".join(DETAIL_FIELDS)), (product_id,))
+    if not rows:
+        return None
+    details = dict(zip(DETAIL_FIELDS, rows[0]))
+    details['labels'] = sorted(parse_labels(details['labels']))
+    return details
+
+
+def chain_stores(conn):
+    '''
+    Returns the store table, loaded once, as a dictionary from chain name
+    to the list of its stores (dictionaries with the id, name, address
+    and zipcode), in id order.
+    '''
+    global _STORES
+    with _STORES_LOCK:
+        if _STORES is None:
+            stores = {}
+            for (store_id, name, address, zipcode) in conn.execute(
+                    "SELECT id, name, address, zipcode FROM store "
+                    "ORDER BY id"):
+                stores.setdefault(name, []).append(
+                    {'id': store_id, 'name': name, 'address': address,
+                     'zipcode': zipcode})
+            _STORES = stores
+        return _STORES
+
+
+def zipcode_prefix(args_from_ui):
+    '''
+    Returns the prefix store zipcodes must start with, or None.
+    '''
+    if 'zipcode' not in args_from_ui:
+        return None
+    return args_from_ui['zipcode'][:-1]
+
+
+def matching_stores(stores, args_from_ui, nearby=None):
+    '''
+    Keep the stores matching the zipcode criteria.  With nearby stores
+    (see store_locator.find_nearby), they are returned closest first, as
+    copies that also carry their distance and rank.
+    '''
+    if nearby is not None:
+        rank = {store_id: i for (i, store_id) in enumerate(nearby)}
+        return sorted((dict(store, distance=nearby[store['id']],
+                            rank=rank[store['id']])
+                       for store in stores if store['id'] in nearby),
+                      key=lambda store: store['rank'])
+    prefix = zipcode_prefix(args_from_ui)
+    if prefix is None:
+        return stores
+    return [store for store in stores if store['zipcode'] is not None and
+            str(store['zipcode']).startswith(prefix)]
+
+
+def store_rank(nearby):
+    '''
+    Returns an SQL expression giving the position of store.id among the
+    nearby stores, closest first.
+    '''
+    return _store_case(nearby, range(len(nearby)))
+
+
+def _store_case(nearby, values):
+    # Ids and values are numbers computed here, never user input
+    if not nearby:
+        return "NULL"
+    return "CASE store.id {} END".format(" ".join(
+        "WHEN {:d} THEN {!r}".format(store_id, value)
+        for (store_id, value) in zip(nearby, values)))
+
+
+def make_select(args_from_ui, nearby=None):
+    select = []
+    for column in select_columns(args_from_ui, nearby):
+        if column == "store.distance":
+            column = _store_case(nearby, nearby.values()) + " AS distance"
+        select.append(column)
+    return "SELECT " + ", ".join(select)
+
+
+def select_columns(args_from_ui, nearby=None):
+    '''
+    Returns the list of qualified columns shown for the search criteria.
+    store.distance, the distance to the zipcode, is only shown with
+    nearby stores.  Searches on ingredients show the product id, whose
+    full ingredients come from product_details, rather than the long
+    ingredient text on every row.
+    '''
     select = ["product.name", "store.name", "store.address"]
-    if 'calories' in args_from_ui:
-        select.append("product.calories")
-    if 'trans_fat' in args_from_ui:
-        select.append("product.trans_fat")
-    if 'tot_fat' in args_from_ui:
-        select.append("product.tot_fat")
-    if 'sodium' in args_from_ui:
-        select.append("product.sodium")
-    if 'tot_carhy' in args_from_ui:
-        select.append("product.tot_carhy")
-    if 'protein' in args_from_ui:
-        select.append("product.protein")
-    if 'sugars' in args_from_ui:
-        select.append("product.sugars")
+    for (field, _) in NUTRIENT_FILTERS:
+        if field in args_from_ui:
+            select.append("product." + field)
     if 'zipcode' in args_from_ui:
         select.append("store.zipcode")
+    if nearby is not None:
+        select.append("store.distance")
     if 'not_contain' in args_from_ui or 'contains' in args_from_ui:
-        select.append("product.ingred") 
-    return base + ", ".join(select)
+        select.append("product.id")
+    return select
 
 
-def make_from(args_from_ui):
+def make_from(args_from_ui, group_stores=False):
+    if group_stores:
+        return " FROM product WHERE "
     return " FROM product JOIN store ON product.store = store.name WHERE "
 
 
-def make_condition(args_from_ui):
+def make_condition(args_from_ui, tables=(), group_stores=False, nearby=None):
     '''
     Get the sqlite query commands
 
     Inputs:
     args_from_ui: a dictionary, containing search criteria and returns courses
     that match the criteria.
+    tables: a collection of table names, the derived search structures
+    (see search_index.py) that can be used instead of LIKE scans
+    group_stores: a boolean, whether the query reads product alone, with
+    the conditions on stores checked by a subquery
+    nearby: a dictionary from the ids of the stores near the zipcode to
+    their distance, or None to match stores on the zipcode prefix
 
     Outputs:
     query: a list of string, the conditions that will be added to base string
@@ -74,54 +1004,187 @@ def make_condition(args_from_ui):
     query = []
     param = ()
 
-    if 'calories' in args_from_ui:
-        query.append("product.calories <= ?")
-        param += (args_from_ui['calories'],)
-    if 'trans_fat' in args_from_ui:
-        query.append("product.trans_fat <= ?")
-        param += (args_from_ui['trans_fat'],)
-    if 'tot_fat' in args_from_ui:
-        query.append("product.tot_fat <= ?")
-        param += (args_from_ui['tot_fat'],)
-    if 'sodium' in args_from_ui:
-        query.append("product.sodium <= ?")
-        param += (args_from_ui['sodium'],)
-    if 'tot_carhy' in args_from_ui:
-        query.append("product.tot_carhy <= ?")
-        param += (args_from_ui['trans_fat'],)
-    if 'protein' in args_from_ui:
-        query.append("product.protein >= ?")
-        param += (args_from_ui['protein'],)
-    if 'sugars' in args_from_ui:
-        query.append("product.sugars <= ?")
-        param += (args_from_ui['sugars'],)
-
-    if 'labels' in args_from_ui:
-        for label in args_from_ui['labels']:
+    # Bind floats, not strings, so the comparison can use the indexes on
+    # the REAL nutrient columns
+    for (field, op) in NUTRIENT_FILTERS:
+        if field in args_from_ui:
+            query.append("product.{} {} ?".format(field, op))
+            param += (float(args_from_ui[field]),)
+
+    query, param = make_label_condition(args_from_ui, tables, query, param)
+
+    query, param = make_match_condition(args_from_ui, tables, query, param)
+    query, param = make_store_condition(args_from_ui, query, param,
+                                        group_stores, nearby)
+    query, param = make_exclude_condition(args_from_ui, tables, query, param)
+    return query, param
+
+
+def requested_labels(args_from_ui):
+    '''
+    Returns the sorted canonical labels requested, leaving out the empty
+    ones (the "No preference" choice of the form).
+    '''
+    labels = {canonical_label(label)
+              for label in args_from_ui.get('labels') or ()}
+    labels.discard('')
+    return sorted(labels)
+
+
+def make_label_condition(args_from_ui, tables, query, param):
+    '''
+    Add the conditions on dietary labels.  With the label table, the
+    requested labels are turned into one mask and tested against
+    product.label_mask with a single AND; the mask is NULL, so nothing
+    matches, when a label is not in the vocabulary.
+    '''
+    labels = requested_labels(args_from_ui)
+    if not labels:
+        return query, param
+
+    if 'label' not in tables:
+        for label in labels:
             query.append("product.labels LIKE ?")
             param += ('%' + label + '%',)
+        return query, param
+
+    mask = ("(SELECT CASE WHEN COUNT(*) = ? THEN SUM(1 << bit) END "
+            "FROM label WHERE name IN (%s))" % ",".join('?' * len(labels)))
+    query.append("product.label_mask & {0} = {0}".format(mask))
+    param += ((len(labels),) + tuple(labels)) * 2
+    return query, param
 
-    if 'product_name' in args_from_ui:
-        for word in args_from_ui['product_name'].split():
+
+def make_match_condition(args_from_ui, tables, query, param):
+    '''
+    Add the conditions on words of the product name and on ingredients
+    the product must contain.  With product_fts they are combined into a
+    single MATCH expression, otherwise each word is a LIKE scan.  Fuzzy
+    name words go through make_fuzzy_condition instead.
+    '''
+    name_words = args_from_ui.get('product_name', '').split()
+    ingred_words = [word.strip(',')
+                    for word in args_from_ui.get('contains', '').split()]
+    if args_from_ui.get('fuzzy') and 'name_trigram' in tables:
+        for word in name_words:
+            for token in WORD_RE.findall(word.lower()):
+                query, param = make_fuzzy_condition(token, tables, query,
+                                                    param)
+        name_words = []
+
+    if 'product_fts' not in tables:
+        for word in name_words:
             query.append("product.name LIKE ?")
             param += ('%' + word + '%',)
+        for word in ingred_words:
+            query.append("product.ingred LIKE ?")
+            param += ('%' + word + '%',)
+        return query, param
+
+    match = ['name : ' + fts_phrase(word)
+             for word in name_words if fts_phrase(word)]
+    match += ['ingred : ' + fts_phrase(word)
+              for word in ingred_words if fts_phrase(word)]
+    if match:
+        query.append("product.id IN (SELECT rowid FROM product_fts "
+                     "WHERE product_fts MATCH ?)")
+        param += (" AND ".join(match),)
+    return query, param
+
+
+def make_fuzzy_condition(token, tables, query, param):
+    '''
+    Add the condition that the product name has a word starting with
+    token, as without fuzzy, or one of the words most similar to token.
+    The candidate words share at least half of its trigrams, found with
+    name_trigram, and only they are compared with token by Jaro-Winkler
+    similarity.
+    '''
+    grams = sorted(trigrams(token))
+    if 'product_fts' in tables:
+        exact = ("product.id IN (SELECT rowid FROM product_fts "
+                 "WHERE product_fts MATCH ?)")
+        exact_param = ('name : ' + fts_phrase(token),)
+    else:
+        exact = "product.name LIKE ?"
+        exact_param = ('%' + token + '%',)
+    query.append(
+        "(" + exact + " OR product.id IN (SELECT product_id FROM name_token "
+        "WHERE token IN (SELECT token FROM name_trigram "
+        "WHERE trigram IN ({}) GROUP BY token "
+        "HAVING COUNT(*) >= ? AND jaro_winkler(token, ?) >= ? "
+        "ORDER BY jaro_winkler(token, ?) DESC, token LIMIT ?)))".format(
+            ", ".join("?" * len(grams))))
+    param += exact_param + tuple(grams) + (
+        max(1, len(grams) // 2), token, MIN_SIMILARITY, token, MAX_SIMILAR)
+    return query, param
+
+
+def make_exclude_condition(args_from_ui, tables, query, param):
+    '''
+    Add the conditions on ingredients the product must not contain.
+
+    With ingredient_token, the products listing any of the words are
+    subtracted using the inverted index, matching whole ingredient words
+    in the singular or plural ("oat" excludes "oats", "cookie" excludes
+    "cookies", but not "coated").  Otherwise fall back to
+    product_fts, then to NOT LIKE scans.
+    '''
+    if 'not_contain' not in args_from_ui:
+        return query, param
+    words = [word.strip(',') for word in args_from_ui['not_contain'].split()]
+
+    if 'ingredient_token' in tables:
+        tokens = sorted({token for word in words
+                         for token in query_tokens(word)})
+        # Products without ingredients never pass, as with NOT LIKE
+        query.append("product.ingred IS NOT NULL")
+        if tokens:
+            query.append("product.id NOT IN (SELECT product_id FROM "
+                         "ingredient_token WHERE token IN (%s))" %
+                         ",".join('?' * len(tokens)))
+            param += tuple(tokens)
+    elif 'product_fts' in tables:
+        exclude = [fts_phrase(word) for word in words if fts_phrase(word)]
+        query.append("product.ingred IS NOT NULL")
+        if exclude:
+            query.append("product.id NOT IN (SELECT rowid FROM product_fts "
+                         "WHERE product_fts MATCH ?)")
+            param += ("ingred : (" + " OR ".join(exclude) + ")",)
+    else:
+        for word in words:
+            query.append("product.ingred NOT LIKE ?")
+            param += ('%' + word + '%',)
+    return query, param
+
 
+def make_store_condition(args_from_ui, query, param, group_stores=False,
+                         nearby=None):
+    '''
+    Add the conditions on the store chain and the zipcode: the store must
+    be one of the nearby stores, or its zipcode must share the prefix.
+    When grouping stores, the product must have at least one matching
+    store instead.
+    '''
     if 'store_name' in args_from_ui:
         query.append("product.store IN (%s)" %
                      ",".join('?' * len(args_from_ui['store_name'])))
         param += tuple(args_from_ui['store_name'])
-    if 'zipcode' in args_from_ui:
-        query.append("store.zipcode LIKE ?")
-        param += (args_from_ui['zipcode'][:-1] + '%',)
 
-    if 'contains' in args_from_ui:
-        for word in args_from_ui['contains'].split():
-            query.append("product.ingred LIKE ?")
-            param += ('%' + word.strip(',') + '%',)
-    if 'not_contain' in args_from_ui:
-        for word in args_from_ui['not_contain'].split():
-            query.append("product.ingred NOT LIKE ?")
-            param += ('%' + word.strip(',') + '%',)
+    store_query = []
+    if nearby is not None:
+        store_query.append("store.id IN (%s)" %
+                           ",".join('?' * len(nearby)))
+        param += tuple(nearby)
+    elif 'zipcode' in args_from_ui:
+        store_query.append("store.zipcode LIKE ?")
+        param += (zipcode_prefix(args_from_ui) + '%',)
+
+    if group_stores:
+        query.append("EXISTS (SELECT 1 FROM store WHERE " + " AND ".join(
+            ["store.name = product.store"] + store_query) + ")")
+    else:
+        query += store_query
     return query, param
 
 
@@ -0,0 +1,139 @@
+'''
+Nearest-store lookups on the grid of store locations built by
+search_index.py.
+
+The grid is loaded once; a lookup only visits the cells around the
+search point instead of computing the distance to every store.
+'''
+
+import math
+import threading
+
+from search_index import CELL_DEGREES, grid_cell
+
+
+# Radius used when a zipcode is given without a distance, in miles
+DEFAULT_RADIUS = 5.0
+EARTH_RADIUS = 3958.8
+MILES_PER_DEGREE = 2 * math.pi * EARTH_RADIUS / 360
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    '''
+    Returns the great-circle distance between two points, in miles.
+    '''
+    (phi1, phi2) = (math.radians(lat1), math.radians(lat2))
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = (math.sin(dphi / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+class StoreGrid:
+    '''
+    The store locations, bucketed by grid cell.
+    '''
+
+    def __init__(self, conn):
+        self.cells = {}
+        for (store_id, latitude, longitude, cell_lat, cell_lon) in \
+                conn.execute("SELECT store_id, latitude, longitude, "
+                             "cell_lat, cell_lon FROM store_location"):
+            self.cells.setdefault((cell_lat, cell_lon), []).append(
+                (store_id, latitude, longitude))
+        self.size = sum(len(stores) for stores in self.cells.values())
+
+    def _ring(self, center, n):
+        '''
+        Yield the stores in the cells at distance n (in cells) of center.
+        '''
+        (row, col) = center
+        for i in range(row - n, row + n + 1):
+            for j in range(col - n, col + n + 1):
+                if max(abs(i - row), abs(j - col)) == n:
+                    yield from self.cells.get((i, j), ())
+
+    def nearest(self, latitude, longitude, k=None, radius=None):
+        '''
+        Returns the (store id, distance in miles) pairs of the stores
+        nearest to a point, closest first: at most k of them when k is
+        given, and only those within radius miles when it is given.
+        '''
+        center = grid_cell(latitude, longitude)
+        # Smallest distance from the point to a cell n rings away
+        cell_miles = CELL_DEGREES * MILES_PER_DEGREE * min(
+            1, math.cos(math.radians(abs(latitude) + CELL_DEGREES)))
+        found = []
+        seen = 0
+        n = 0
+        while seen < self.size:
+            for (store_id, lat, lon) in self._ring(center, n):
+                seen += 1
+                found.append((haversine(latitude, longitude, lat, lon),
+                              store_id))
+            # Stores in further rings are at least this far away
+            reach = n * cell_miles
+            if radius is not None and reach > radius:
+                break
+            if k is not None and len(found) >= k and \
+                    sorted(found)[k - 1][0] <= reach:
+                break
+            n += 1
+        found.sort()
+        if radius is not None:
+            found = [pair for pair in found if pair[0] <= radius]
+        if k is not None:
+            found = found[:k]
+        return [(store_id, distance) for (distance, store_id) in found]
+
+
+_GRID = None
+_LOCK = threading.Lock()
+
+
+def get_grid(conn):
+    '''
+    Returns the StoreGrid, loading it on first use.
+    '''
+    global _GRID
+    with _LOCK:
+        if _GRID is None:
+            _GRID = StoreGrid(conn)
+        return _GRID
+
+
+def clear():
+    '''
+    Drop the loaded grid, e.g. after the database has been rebuilt.
+    '''
+    global _GRID
+    with _LOCK:
+        _GRID = None
+
+
+def find_nearby(conn, args_from_ui, tables):
+    '''
+    Returns the stores near the centroid of args_from_ui['zipcode'], as a
+    dictionary from store id to distance rounded to 0.01 mile, closest
+    first: the args_from_ui['nearest'] closest stores when it is given,
+    and only those within args_from_ui['distance'] miles when it is given
+    (DEFAULT_RADIUS when neither is).  Returns None when there is no
+    zipcode, the database has no store locations or the zipcode is
+    unknown; the search then falls back to matching zipcode prefixes.
+    '''
+    if 'zipcode' not in args_from_ui or 'store_location' not in tables:
+        return None
+    centroid = conn.execute(
+        "SELECT latitude, longitude FROM zipcode WHERE zipcode = ?",
+        (str(args_from_ui['zipcode']).strip(),)).fetchone()
+    if centroid is None:
+        return None
+    k = args_from_ui.get('nearest')
+    radius = args_from_ui.get('distance')
+    if k is None and radius is None:
+        radius = DEFAULT_RADIUS
+    return {store_id: round(distance, 2) for (store_id, distance) in
+            get_grid(conn).nearest(
+                *centroid, k=None if k is None else int(k),
+                radius=None if radius is None else float(radius))}
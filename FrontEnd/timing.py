@@ -0,0 +1,151 @@
+'''
+Phase timing of searches, for Server-Timing headers and the slow search
+log.
+
+A request records its timings inside `with record():`.  Within it, the
+phase() blocks and the queries run by fetch_all or fetch_rows add up
+their durations per phase name; outside of it they cost nothing more than a lookup.
+'''
+
+import contextvars
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+
+LOGGER = logging.getLogger('search.slow')
+# Rows read at a time by fetch_rows
+FETCH_ROWS = 1024
+
+_CURRENT = contextvars.ContextVar('search_timings', default=None)
+
+
+class Timings:
+    '''
+    The durations, in seconds, of the phases of one request and of the
+    SQL queries it ran.
+    '''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        # (sql, parameters, number of rows, seconds) of each query
+        self.queries = []
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        '''
+        Returns the value of a Server-Timing header, in milliseconds.
+        '''
+        phases = list(self.phases.items()) + [('total', self.elapsed())]
+        return ', '.join('{};dur={:.2f}'.format(name, seconds * 1000)
+                         for (name, seconds) in phases)
+
+    def log_if_slow(self, threshold_ms, **context):
+        '''
+        Log the phases and queries as one JSON object to the search.slow
+        logger, with context, when the request took threshold_ms or more.
+        '''
+        elapsed = self.elapsed()
+        if elapsed * 1000 < threshold_ms:
+            return
+        entry = dict(context)
+        entry['ms'] = round(elapsed * 1000, 2)
+        entry['phases'] = {name: round(seconds * 1000, 2)
+                           for (name, seconds) in self.phases.items()}
+        entry['queries'] = [
+            {'sql': sql, 'params': params, 'rows': rows,
+             'ms': round(seconds * 1000, 2)}
+            for (sql, params, rows, seconds) in self.queries]
+        LOGGER.warning(json.dumps(entry, default=str))
+
+
+@contextmanager
+def record():
+    '''
+    Record the timings of the with block, which gets the Timings.
+    '''
+    timings = Timings()
+    token = _CURRENT.set(timings)
+    try:
+        yield timings
+    finally:
+        _CURRENT.reset(token)
+
+
+def current():
+    '''
+    Returns the Timings being recorded, or None.
+    '''
+    return _CURRENT.get()
+
+
+@contextmanager
+def phase(name):
+    '''
+    Add the duration of the with block to the phase name.
+    '''
+    timings = _CURRENT.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def fetch_all(c, sql, params=()):
+    '''
+    Run a query on a connection or cursor and return all its rows, timing
+    the execute and fetch phases and keeping the query for the log.
+    '''
+    timings = _CURRENT.get()
+    start = time.perf_counter()
+    cursor = c.execute(sql, params)
+    executed = time.perf_counter()
+    rows = cursor.fetchall()
+    if timings is not None:
+        end = time.perf_counter()
+        timings.add('execute', executed - start)
+        timings.add('fetch', end - executed)
+        timings.queries.append((sql, tuple(params), len(rows), end - start))
+    return rows
+
+
+def fetch_rows(c, sql, params=(), size=FETCH_ROWS):
+    '''
+    Run a query on a connection or cursor and generate its rows, fetched
+    size at a time, so that they can be consumed as they arrive rather
+    than held in one list.  The execute and fetch phases and the query
+    are recorded like fetch_all once the rows have been read.
+    '''
+    timings = _CURRENT.get()
+    start = time.perf_counter()
+    cursor = c.execute(sql, params)
+    executed = time.perf_counter()
+    fetch = 0
+    count = 0
+    try:
+        while True:
+            before = time.perf_counter()
+            rows = cursor.fetchmany(size)
+            fetch += time.perf_counter() - before
+            if not rows:
+                break
+            count += len(rows)
+            yield from rows
+    finally:
+        if timings is not None:
+            timings.add('execute', executed - start)
+            timings.add('fetch', fetch)
+            timings.queries.append((sql, tuple(params), count,
+                                    executed - start + fetch))
+
@@ -0,0 +1,15 @@
+"""
+ASGI config for ui project.
+
+It exposes the ASGI callable as a module-level variable named
+``application``, e.g. for ``uvicorn ui.asgi:application``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
+"""
+
+import os
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ui.settings")
+
+from django.core.asgi import get_asgi_application
+application = get_asgi_application()
@@ -36,7 +36,7 @@ INSTALLED_APPS = (
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'search',
+    'search.apps.SearchConfig',
 )
 
 MIDDLEWARE = [
@@ -103,3 +103,24 @@ STATIC_URL = '/static/'
 STATICFILES_DIRS = (
     os.path.join(BASE_DIR, "static"),
 )
+
+
+# Search engine used by search_items.search: 'sql' or 'numpy'
+SEARCH_ENGINE = 'sql'
+
+# Serve the database as an immutable, memory-mapped file and warm it up at
+# startup.  Replace foodsearch.sqlite3 by renaming a new file over it,
+# never by writing to it, while the server runs with this mode on.
+SEARCH_MMAP = False
+
+# Searches taking this long or more (in milliseconds) are logged with
+# their phases and SQL queries to the search.slow logger
+SLOW_SEARCH_MS = 500
+
+# Let any user profile a search by adding the cprofile parameter to its
+# URL (see profiling.py); staff users always may
+SEARCH_PROFILING = False
+
+# Stream the search page: the form goes out before the search runs, and
+# the result rows follow in chunks
+SEARCH_STREAM = False